@@ -1,4 +1,19 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+from setuptools.command.build_ext import build_ext
+
+
+class CTypesExtension(Extension):
+    """
+    Shared library without a Python module init function, loaded with ctypes.
+    """
+
+
+class build_ctypes_ext(build_ext):
+    def get_export_symbols(self, ext):
+        if isinstance(ext, CTypesExtension):
+            return ext.export_symbols
+        return super().get_export_symbols(ext)
+
 
 setup(
     name="stegosphere",
@@ -10,6 +25,15 @@ setup(
     url="https://github.com/Maximilian-Koch/stegosphere",
     packages=find_packages(include=["stegosphere", "stegosphere.*"]),
     include_package_data=True,
+    #optional: without a compiler, the methods fall back to NumPy
+    ext_modules=[
+        CTypesExtension(
+            "stegosphere.methods.backend.lsb",
+            sources=["stegosphere/methods/backend/LSB_c.c"],
+            optional=True,
+        )
+    ],
+    cmdclass={"build_ext": build_ctypes_ext},
     install_requires=[
         "numpy"
     ],
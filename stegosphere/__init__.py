@@ -1,6 +1,7 @@
+from stegosphere.bitbuffer import BitBuffer
 from stegosphere.io import binary_to_data, binary_to_file, data_to_binary, file_to_binary
 
-__all__ = ['binary_to_data', 'binary_to_file', 'data_to_binary', 'file_to_binary']
+__all__ = ['BitBuffer', 'binary_to_data', 'binary_to_file', 'data_to_binary', 'file_to_binary']
 
 __author__ = 'Maximilian J. W. Koch'
 
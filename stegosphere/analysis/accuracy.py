@@ -1,18 +1,21 @@
 import numpy as np
 
+from stegosphere.bitbuffer import BitBuffer
+
 def hamming_distance(before, after):
     """
     Compute Hamming Distance (HD)
     
-    :param before: Binary string or NumPy array
-    :param after: Binary string or NumPy array
+    :param before: Binary string, BitBuffer or NumPy array
+    :param after: Binary string, BitBuffer or NumPy array
     :return: Hamming Distance (integer)
     """
     assert len(before) == len(after), "Inputs must be of equal length"
 
-    if isinstance(before, str) and isinstance(after, str):
-        before = np.array(list(before))
-        after = np.array(list(after))
+    if isinstance(before, (str, BitBuffer)) and isinstance(after, (str, BitBuffer)):
+        before = BitBuffer.from_str(before) if isinstance(before, str) else before
+        after = BitBuffer.from_str(after) if isinstance(after, str) else after
+        return int(np.unpackbits(before.data ^ after.data).sum())
 
     return np.sum(before != after)
 
@@ -21,7 +24,7 @@ def bit_error_rate(before, after):
     Compute Bit Error Rate (BER)
     """
     assert len(before) == len(after)
-    if before == '':
+    if len(before) == 0:
         return 0
     return hamming_distance(before, after) / len(before)
 
@@ -0,0 +1,233 @@
+import operator
+
+import numpy as np
+
+__all__ = ['BitBuffer', 'as_bits']
+
+
+class BitBuffer:
+    """
+    A sequence of bits, stored packed in a uint8 array.
+
+    Bits are ordered most significant bit first, as in np.packbits/np.unpackbits.
+    Padding bits in the last byte are always zero, so two buffers with equal
+    bits also have equal data.
+    Binary strings ('0'/'1') are supported as an adapter, see from_str and str().
+    """
+    __slots__ = ('data', 'length')
+
+    def __init__(self, data=b'', length=None):
+        """
+        :param data: Packed bits.
+        :type data: bytes, np.ndarray
+        :param length: Number of valid bits in data. Defaults to all bits of data.
+        :type length: int, optional
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype=np.uint8)
+        data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+        if length is None:
+            length = data.size * 8
+        length = int(length)
+        n_bytes = (length + 7) // 8
+        if length < 0 or n_bytes > data.size:
+            raise ValueError(f'length {length} does not fit into {data.size} bytes.')
+        data = data[:n_bytes]
+        pad = n_bytes * 8 - length
+        if pad and data[-1] & ((1 << pad) - 1):
+            data = data.copy()
+            data[-1] &= (0xFF << pad) & 0xFF
+        self.data = data
+        self.length = length
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Creates a BitBuffer from an array of bit values (0/1 or bool).
+        """
+        bits = np.asarray(bits).reshape(-1)
+        if bits.dtype != np.bool_:
+            bits = bits.astype(np.uint8, copy=False)
+        return cls(np.packbits(bits), bits.size)
+
+    @classmethod
+    def from_str(cls, string):
+        """
+        Creates a BitBuffer from a binary string, e.g. '0110'.
+        """
+        try:
+            values = np.frombuffer(string.encode('ascii'), dtype=np.uint8) - ord('0')
+        except UnicodeEncodeError:
+            raise ValueError('binary string may only contain 0 and 1.') from None
+        if values.size and values.max() > 1:
+            raise ValueError('binary string may only contain 0 and 1.')
+        return cls.from_bits(values)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Creates a BitBuffer holding all bits of a bytes-like object.
+        """
+        return cls(data)
+
+    @classmethod
+    def from_int(cls, value, width):
+        """
+        Creates a BitBuffer of the binary representation of an unsigned integer.
+
+        :param value: The integer.
+        :type value: int
+        :param width: Number of bits, the value is zero-padded on the left.
+        :type width: int
+        """
+        value = int(value)
+        if value < 0 or value.bit_length() > width:
+            raise ValueError(f'{value} cannot be represented with {width} bits.')
+        n_bytes = (width + 7) // 8
+        return cls(value.to_bytes(n_bytes, 'big'))[n_bytes * 8 - width:]
+
+    def unpack(self):
+        """
+        Returns the bits as a uint8 array of 0/1 values.
+        """
+        return np.unpackbits(self.data, count=self.length)
+
+    def tobytes(self):
+        """
+        Returns the packed bits. The last byte is zero-padded.
+        """
+        return self.data.tobytes()
+
+    def to_int(self):
+        """
+        Interprets the bits as an unsigned big-endian integer.
+        """
+        return int.from_bytes(self.data.tobytes(), 'big') >> (len(self.data) * 8 - self.length)
+
+    def find(self, sub, start=0):
+        """
+        Returns the lowest bit index at which sub is found, or -1.
+
+        :param sub: The bits to search for.
+        :type sub: BitBuffer, str
+        :param start: Index to start searching from.
+        :type start: int
+        """
+        pattern = as_bits(sub)
+        start = max(0, min(start, self.length))
+        if len(pattern) == 0:
+            return start
+        if self.length - start < len(pattern):
+            return -1
+        if len(pattern) >= 15:
+            return self._find_bytes(pattern, start)
+        return self._find_bits(pattern, start)
+
+    def _find_bits(self, pattern, start):
+        #narrows down candidate positions bit by bit
+        pattern = pattern.unpack()
+        bits = self[start:].unpack()
+        candidates = np.flatnonzero(bits[:bits.size - pattern.size + 1] == pattern[0])
+        for offset in range(1, pattern.size):
+            if candidates.size == 0:
+                break
+            candidates = candidates[bits[candidates + offset] == pattern[offset]]
+        if candidates.size == 0:
+            return -1
+        return start + int(candidates[0])
+
+    def _find_bytes(self, pattern, start):
+        #for each of the 8 bit alignments, searches the whole bytes of the pattern in the packed data
+        m = len(pattern)
+        first_byte = start // 8
+        raw = self.data[first_byte:].tobytes()
+        best = -1
+        for lead in range(8):
+            #occurrences starting `lead` bits before a byte boundary
+            key = pattern[lead:lead + (m - lead) // 8 * 8].tobytes()
+            byte_index = raw.find(key)
+            while byte_index >= 0:
+                position = (first_byte + byte_index) * 8 - lead
+                if best >= 0 and position >= best:
+                    break
+                if position >= start and position + m <= self.length and self[position:position + m] == pattern:
+                    best = position
+                    break
+                byte_index = raw.find(key, byte_index + 1)
+        return best
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return BitBuffer.from_bits(self.unpack()[key])
+            stop = max(start, stop)
+            first = start // 8
+            chunk = self.data[first:(stop + 7) // 8]
+            offset = start - first * 8
+            if offset == 0:
+                return BitBuffer(chunk, stop - start)
+            return BitBuffer.from_bits(np.unpackbits(chunk)[offset:offset + stop - start])
+        index = operator.index(key)
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('BitBuffer index out of range')
+        return int((self.data[index >> 3] >> (7 - (index & 7))) & 1)
+
+    def __iter__(self):
+        return iter(self.unpack().tolist())
+
+    def __add__(self, other):
+        try:
+            other = as_bits(other)
+        except TypeError:
+            return NotImplemented
+        if self.length % 8 == 0:
+            return BitBuffer(np.concatenate((self.data, other.data)), self.length + other.length)
+        return BitBuffer.from_bits(np.concatenate((self.unpack(), other.unpack())))
+
+    def __radd__(self, other):
+        try:
+            other = as_bits(other)
+        except TypeError:
+            return NotImplemented
+        return other + self
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return str(self) == other
+        if isinstance(other, BitBuffer):
+            return self.length == other.length and np.array_equal(self.data, other.data)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __str__(self):
+        return (self.unpack() + ord('0')).tobytes().decode('ascii')
+
+    def __repr__(self):
+        if self.length > 64:
+            return f"BitBuffer('{self[:64]}...', length={self.length})"
+        return f"BitBuffer('{self}')"
+
+
+def as_bits(data):
+    """
+    Converts a binary string or an array of bit values into a BitBuffer.
+    BitBuffers are returned as they are.
+
+    :param data: The bits.
+    :type data: BitBuffer, str, np.ndarray
+    :return: BitBuffer
+    """
+    if isinstance(data, BitBuffer):
+        return data
+    if isinstance(data, str):
+        return BitBuffer.from_str(data)
+    if isinstance(data, np.ndarray):
+        return BitBuffer.from_bits(data)
+    raise TypeError(f'Cannot interpret {type(data).__name__} as bits.')
@@ -12,3 +12,4 @@ METADATA_LENGTH_TTF = 32
 
 METADATA_LENGTH_LSB = 32
 METADATA_LENGTH_VD = 32
+METADATA_LENGTH_IWT = 32
@@ -1,13 +1,23 @@
+import io
+import os
 import re
+import warnings
 
+import numpy as np
+
+from stegosphere.bitbuffer import BitBuffer, as_bits
 from stegosphere.tools import compression
 
-def encode_payload(payload, method='metadata', metadata_length=32, delimiter_message='###END###', compress=False):
+#Number of bytes read from a file at once by PayloadStream
+STREAM_CHUNK_SIZE = 1 << 20
+
+def encode_payload(payload, method='metadata', metadata_length=32, delimiter_message='###END###', compress=False,
+                   stream=False):
     """
     Prepares a payload for embedding.
 
-    :param payload: The payload to be embedded
-    :type payload: str
+    :param payload: The payload to be embedded. File-like objects are read from their current position.
+    :type payload: str, bytes, BitBuffer, file-like object
     :param method: The method for end-of-message signifying, either 'metadata', 'delimiter' or None
     :type method: str/None
     :param metadata_length: The length of the block denoting the number of embedded bits.
@@ -16,13 +26,27 @@ def encode_payload(payload, method='metadata', metadata_length=32, delimiter_mes
     :type delimiter_message: str
     :param compress: Use compression to compress the payload
     :type compress: bool, str
+    :param stream: Whether file-like payloads are returned as PayloadStream instead of being read at once.
+                   Not possible with compression.
+    :type stream: bool
+    :return: The payload bits
+    :rtype: BitBuffer, PayloadStream
     """
-    payload_format = check_type(payload)
-    if payload_format == 1:
-        #Hex messages are a common output after encryption, thus treated specifically
-        payload = hex_to_binary(payload)
-    elif payload_format == 2:
+    if hasattr(payload, 'read'):
+        if stream and not compress:
+            return PayloadStream(payload, method, metadata_length, delimiter_message)
+        payload = payload.read()
+    if isinstance(payload, (bytes, bytearray)):
         payload = data_to_binary(payload)
+    elif not isinstance(payload, BitBuffer):
+        payload_format = check_type(payload)
+        if payload_format == 0:
+            payload = BitBuffer.from_str(payload)
+        elif payload_format == 1:
+            #Hex messages are a common output after encryption, thus treated specifically
+            payload = BitBuffer.from_str(hex_to_binary(payload))
+        else:
+            payload = data_to_binary(payload)
 
     if compress:
         previous_length = len(payload)
@@ -32,24 +56,140 @@ def encode_payload(payload, method='metadata', metadata_length=32, delimiter_mes
             warnings.warn('message length increased due to compression. That might be the case for already compressed data.')
         
     if method == 'delimiter':
-        if not is_binary(delimiter_message):
-            delimiter_message = data_to_binary(delimiter_message)
-        payload += delimiter_message
-        assert payload.count(delimiter_message)==1, Exception('Delimiter appears in data. Use another delimiter or change data minimally.')
+        delimiter = delimiter_to_binary(delimiter_message)
+        message_length = len(payload)
+        payload += delimiter
+        assert payload.find(delimiter) == message_length, Exception('Delimiter appears in data. Use another delimiter or change data minimally.')
     elif method == 'metadata':
-        payload = f"{len(payload):0{metadata_length}b}" + payload
+        payload = BitBuffer.from_int(len(payload), metadata_length) + payload
     elif method is not None:
         raise Exception('Method must be either delimiter, metadata or None.')
     
     return payload
 
 
+class PayloadStream:
+    """
+    Payload read from a binary file-like object on demand, so that the file is never held in memory as a whole.
+    The end-of-message marker is added on the fly, with the metadata computed from the file size.
+    """
+    def __init__(self, file, method='metadata', metadata_length=32, delimiter_message='###END###'):
+        """
+        :param file: Binary file-like object, read from its current position. Non-seekable input such as pipes is
+                     read into memory at once, as its size is needed in advance.
+        :param method: The method for end-of-message signifying, either 'metadata', 'delimiter' or None
+        :type method: str/None
+        :param metadata_length: The length of the block denoting the number of embedded bits.
+        :type metadata_length: int
+        :param delimiter_message: The delimiter to use as end-of-message
+        :type delimiter_message: str
+        """
+        try:
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END) - position
+            file.seek(position)
+        except (AttributeError, OSError):
+            data = file.read()
+            file = io.BytesIO(data)
+            size = len(data)
+        self.file = file
+        self.message_length = size * 8
+        self._prefix = BitBuffer()
+        self._suffix = BitBuffer()
+        self._delimiter = None
+        if method == 'metadata':
+            self._prefix = BitBuffer.from_int(self.message_length, metadata_length)
+        elif method == 'delimiter':
+            self._delimiter = delimiter_to_binary(delimiter_message)
+            self._suffix = self._delimiter
+        elif method is not None:
+            raise Exception('Method must be either delimiter, metadata or None.')
+        self.length = len(self._prefix) + self.message_length + len(self._suffix)
+        self._pending = self._prefix
+        self._searched = BitBuffer()
+        self._file_done = size == 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, n_bits):
+        """
+        Returns the next n_bits bits of the payload, fewer at its end.
+
+        :rtype: BitBuffer
+        """
+        while len(self._pending) < n_bits and not (self._file_done and self._suffix is None):
+            if self._file_done:
+                self._check_end()
+                self._pending += self._suffix
+                self._suffix = None
+                continue
+            data = self.file.read(max(STREAM_CHUNK_SIZE, (n_bits - len(self._pending) + 7) // 8))
+            if not data:
+                self._file_done = True
+                continue
+            self._pending += self._check_delimiter(BitBuffer.from_bytes(data))
+        result = self._pending[:n_bits]
+        self._pending = self._pending[n_bits:]
+        return result
+
+    def _check_delimiter(self, bits):
+        #the delimiter must not appear in the data, also not across chunks
+        if self._delimiter is not None:
+            searched = self._searched + bits
+            if searched.find(self._delimiter) >= 0:
+                raise ValueError('Delimiter appears in data. Use another delimiter or change data minimally.')
+            self._searched = searched[max(0, len(searched) - len(self._delimiter) + 1):]
+        return bits
+
+    def _check_end(self):
+        #the delimiter must also not start within the end of the data
+        if self._delimiter is not None:
+            if (self._searched + self._delimiter).find(self._delimiter) != len(self._searched):
+                raise ValueError('Delimiter appears in data. Use another delimiter or change data minimally.')
+
+
+class PayloadSink:
+    """
+    Writes extracted bits into a binary file-like object as they arrive. Complete bytes are written
+    immediately, remaining bits are kept until the next write or flush.
+    """
+    def __init__(self, file):
+        """
+        :param file: Binary file-like object.
+        """
+        self.file = file
+        self.length = 0
+        self._pending = BitBuffer()
+
+    def write(self, bits):
+        """
+        :param bits: The next bits.
+        :type bits: BitBuffer, str
+        """
+        bits = as_bits(bits)
+        self.length += len(bits)
+        bits = self._pending + bits
+        complete = len(bits) // 8 * 8
+        self.file.write(bits[:complete].tobytes())
+        self._pending = bits[complete:]
+
+    def flush(self):
+        """
+        Writes the remaining bits, zero-padded to a full byte.
+        """
+        if len(self._pending):
+            self.file.write(self._pending.tobytes())
+            self._pending = BitBuffer()
+
+
 def file_to_binary(path):
     """
     Converts a file into its binary representation.
     
     :param file_path: Path to the input file
     :return: Binary data of the file
+    :rtype: BitBuffer
     """
     with open(path, 'rb') as file:
         binary_data = file.read()
@@ -66,31 +206,65 @@ def binary_to_file(binary_data, output_path):
     with open(output_path, 'wb') as file:
         file.write(data)
 
-def data_to_binary(data):
+def data_to_binary(data, encoding='utf-8'):
     """
-    Converts data (string or bytes) to a binary string.
+    Converts data (string, bytes, array or integer) to binary.
+    Strings are encoded with encoding, integers are converted to big-endian bytes.
+    Arrays are converted to the raw bytes of their values in C order, e.g. two bytes per int16 value.
     
     :param data: Data to convert
-    :return: Binary string
+    :param encoding: Encoding of strings. Defaults to 'utf-8'.
+    :type encoding: str, optional
+    :return: Binary data
+    :rtype: BitBuffer
     """
     if isinstance(data, str):
-        return ''.join(format(ord(char), '08b') for char in data)
-    elif isinstance(data, bytes) or isinstance(data, np.ndarray):
-        return ''.join(format(byte, '08b') for byte in data)
-    elif isinstance(data, int) or isinstance(data, np.uint8):
-        return format(data, '08b')
+        return BitBuffer.from_bytes(data.encode(encoding))
+    elif isinstance(data, bytes):
+        return BitBuffer.from_bytes(data)
+    elif isinstance(data, (bytearray, memoryview)):
+        #copied, so that later changes of the buffer do not change the payload
+        return BitBuffer.from_bytes(bytes(data))
+    elif isinstance(data, np.ndarray):
+        if data.dtype.hasobject:
+            raise TypeError('Arrays of objects are not supported.')
+        return BitBuffer.from_bytes(np.ascontiguousarray(data).reshape(-1).view(np.uint8))
+    elif isinstance(data, (int, np.integer)):
+        value = int(data)
+        if value < 0:
+            raise ValueError('Negative integers are not supported.')
+        return BitBuffer.from_int(value, max(1, (value.bit_length() + 7) // 8) * 8)
     else:
         raise TypeError("Type not supported.")
 
-def binary_to_data(binary):
+def binary_to_data(binary, encoding=None):
     """
-    Converts binary string to data.
+    Converts binary data to data.
+    An incomplete last byte is padded with zeros.
     
-    :param binary: Binary string to convert
-    :return: Data as bytes
+    :param binary: Binary data to convert
+    :type binary: BitBuffer, str
+    :param encoding: If given, the bytes are decoded into a string with this encoding, e.g. 'utf-8'.
+    :type encoding: str, optional
+    :return: Data as bytes, or str if encoding is given
+    """
+    data = as_bits(binary).tobytes()
+    if encoding is not None:
+        return data.decode(encoding)
+    return data
+
+def delimiter_to_binary(delimiter_message):
+    """
+    Converts a delimiter into binary. Binary strings are used as they are.
+
+    :param delimiter_message: The delimiter
+    :type delimiter_message: str, BitBuffer
+    :return: Binary delimiter
+    :rtype: BitBuffer
     """
-    all_bytes = [binary[i: i + 8] for i in range(0, len(binary), 8)]
-    return bytes([int(byte, 2) for byte in all_bytes])
+    if is_binary(delimiter_message):
+        return as_bits(delimiter_message)
+    return data_to_binary(delimiter_message)
 
 def is_binary(data):
     """
@@ -99,6 +273,8 @@ def is_binary(data):
     :param data: data to be checked
     :return: bool
     """
+    if isinstance(data, BitBuffer):
+        return True
     return re.fullmatch(r'[01]+', data)
 
 
@@ -118,6 +294,8 @@ def check_type(data):
     :param data: data to be checked
     :return: int, 0 meaning binary, 1 meaning hex, 2 meaning neither
     """
+    if isinstance(data, BitBuffer):
+        return 0
     if is_binary(data):
         return 0 #binary
     elif re.fullmatch(r'[0-9a-fA-F]+', data):
@@ -4,190 +4,350 @@
 #In Multimedia systems and applications (Vol. 3528, pp. 464-473). SPIE.
 
 
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from stegosphere import utils
+from stegosphere.bitbuffer import BitBuffer, as_bits
+
+#One record per used block, in embedding order. Can be stored with np.save or .tobytes().
+CONJ_MAP_DTYPE = np.dtype([('channel', '<u2'), ('bitplane', 'u1'), ('by', '<u4'), ('bx', '<u4'),
+                           ('conjugated', '?')])
 
-def embed(array, payload, block_size = 8, threshold = 0.3):
+def embed(array, payload, block_size = 8, threshold = 0.3, out=None, embedded_map=False, cgc=False, workers=1):
     """
     Generalized BPCS embedding.
 
     :param array: array to be embedded into
     :type array: np.ndarray
     :param payload: payload
-    :type payload: str
+    :type payload: BitBuffer, str
+    :param out: Array to write the result into, e.g. a np.memmap. Use `out=array` to embed in place.
+                Defaults to a copy of array.
+    :type out: np.ndarray, optional
+    :param embedded_map: Whether to store the conjugation flag of each block in the block itself, as in the
+                         original scheme. The first bit of every block is then the flag, and conjugation uses
+                         the checkerboard pattern, so that used blocks stay complex and can be found again
+                         without the map. Requires threshold < 0.5. Defaults to False.
+    :type embedded_map: bool, optional
+    :param cgc: Whether to use the bitplanes of the Canonical Gray Code of the values instead of pure binary.
+                Defaults to False.
+    :type cgc: bool, optional
+    :param workers: Number of threads. Bitplanes are analysed and channels are written concurrently,
+                    the result is identical to workers=1. None uses one thread per CPU. Defaults to 1.
+    :type workers: int, optional
     
     Returns (array, conj_map_records, used_bits).
+    conj_map_records is a structured array of dtype CONJ_MAP_DTYPE. It is not needed for extraction if embedded_map is used.
     """
     assert array.ndim in [2,3], 'Array must be 2 or 3 dimensional'
-    
-    if array.ndim == 2:
-        array_3d = array[:, :, np.newaxis]
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError('Array must have an integer dtype for BPCS.')
+    if embedded_map:
+        _check_embedded_threshold(block_size, threshold)
+
+    out = utils.prepare_out(array, out)
+
+    if out.ndim == 2:
+        array_3d = out[:, :, np.newaxis]
     else:
-        array_3d = array
+        array_3d = out
 
     H, W, C = array_3d.shape
-    array_chw = np.transpose(array_3d, (2, 0, 1))  # shape: (C,H,W)
+    array_chw = utils.unsigned_view(np.transpose(array_3d, (2, 0, 1)))  # shape: (C,H,W)
+    n_bitplanes = array_chw.dtype.itemsize * 8
 
+    payload_bits = as_bits(payload).unpack()
     payload_index = 0
-    payload_length = len(payload)
-    conj_map_records = []
-
-    for channel_idx in range(C):
-        if payload_index >= payload_length:
-            break
-
+    payload_length = len(payload_bits)
+    max_bits = block_size * block_size
+    # Bits of payload per block, the flag takes the first bit if embedded
+    block_capacity = max_bits - 1 if embedded_map else max_bits
+
+    def eligible_blocks(plane):
+        # Complexity check of all blocks at once, eligible blocks in scan order.
+        # Changes to other bitplanes do not affect this one, so bitplanes are independent.
+        channel_idx, bitplane_idx = plane
+        bp = _bitplane(array_chw[channel_idx], bitplane_idx, cgc)
+        # Segment into blocks, partial blocks are skipped
+        return np.argwhere(_compute_complexity(_blocks(bp, block_size)) >= threshold)
+
+    def embed_channel(channel_idx, plan):
+        # Writes the planned blocks of one channel. Bitplanes of a channel share values, so they are written in order.
         channel_data = array_chw[channel_idx]
-        bitplanes = _split_into_bitplanes(channel_data)
-
-        # Iterate over bitplanes
-        for bitplane_idx in range(8):
+        if cgc:
+            _to_gray(channel_data)
+        records = []
+        for bitplane_idx, chosen, start, bits_to_embed in plan:
+            data_arr, was_conjugated = _data_blocks(payload_bits[start:start + bits_to_embed], len(chosen),
+                                                    block_size, threshold, embedded_map)
+            # Embed, writing the bits directly into the channel
+            _write_blocks(channel_data, bitplane_idx, chosen, data_arr, block_size)
+            records.append(_records(channel_idx, bitplane_idx, chosen, was_conjugated, block_size))
+        if cgc:
+            _from_gray(channel_data)
+        return records
+
+    workers = workers or os.cpu_count() or 1
+    executor = ThreadPoolExecutor(workers) if workers > 1 else None
+    try:
+        # Assign the payload to the eligible blocks in scan order: channels, then bitplanes from LSB to MSB
+        planes = [(c, b) for c in range(C) for b in range(n_bitplanes)] if payload_length else []
+        plans = {}
+        for (channel_idx, bitplane_idx), eligible in zip(planes, _ordered_map(executor, eligible_blocks, planes, workers)):
+            bits_left = payload_length - payload_index
+            chosen = eligible[:-(-bits_left // block_capacity)]
+            bits_to_embed = min(len(chosen) * block_capacity, bits_left)
+            plans.setdefault(channel_idx, []).append((bitplane_idx, chosen, payload_index, bits_to_embed))
+            payload_index += bits_to_embed
             if payload_index >= payload_length:
                 break
 
-            bp = bitplanes[bitplane_idx]
+        channel_records = list(_ordered_map(executor, lambda item: embed_channel(*item), plans.items(), workers))
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-            # Segment into blocks
-            for by in range(0, H, block_size):
-                for bx in range(0, W, block_size):
-                    if payload_index >= payload_length:
-                        break
+    used_bits = payload_index
+    conj_map_records = [records for channel in channel_records for records in channel]
+    conj_map_records = np.concatenate(conj_map_records) if conj_map_records else np.empty(0, CONJ_MAP_DTYPE)
 
-                    block = bp[by:by+block_size, bx:bx+block_size]
-                    if block.shape != (block_size, block_size):
-                        continue  # skip partial blocks
+    # array_chw is a view of out
+    return out, conj_map_records, used_bits
 
-                    # Complexity check
-                    c = _compute_complexity(block)
-                    if c >= threshold:
-                        max_bits = block_size * block_size
-                        bits_left = payload_length - payload_index
-                        bits_to_embed = min(max_bits, bits_left)
+def extract(array,conj_map_records,total_bits,block_size = 8, threshold = 0.3, embedded_map = False, cgc = False):
+    """
+    Generalized BPCS extraction.
+    conj_map_records = [(channel_idx, bitplane_idx, by, bx, was_conjugated), ...], or a structured array
+    of dtype CONJ_MAP_DTYPE. Can be None if embedded_map was used, the blocks are then found with the threshold.
+    cgc must be set as for embedding.
+    Returns BitBuffer of length total_bits.
+    """
+    #make 3d
+    if array.ndim == 2:
+        array_3d = array[:, :, np.newaxis]
+    else:
+        array_3d = array
 
-                        data_chunk = payload[payload_index : payload_index + bits_to_embed]
+    H, W, C = array_3d.shape
+    array_chw = utils.unsigned_view(np.transpose(array_3d, (2, 0, 1)))
 
+    if embedded_map:
+        _check_embedded_threshold(block_size, threshold)
+        return _extract_embedded_map(array_chw, total_bits, block_size, threshold, cgc)
 
-                        data_arr = np.zeros((block_size, block_size), dtype=np.int32)
-                        flat = data_arr.ravel()
-                        for i in range(bits_to_embed):
-                            flat[i] = int(data_chunk[i])
-                        data_arr = flat.reshape((block_size, block_size))
+    max_block_bits = block_size * block_size
+    records = _records_to_array(conj_map_records)
+    channel_idx, bitplane_idx, by, bx, was_conjugated = records.T
 
-                        # Check complexity of data_arr
-                        data_complexity = _compute_complexity(data_arr)
-                        was_conjugated = False
-                        if data_complexity < threshold:
-                            data_arr = 1 - data_arr
-                            was_conjugated = True
+    # Only complete blocks hold data
+    complete = (by + block_size <= H) & (bx + block_size <= W)
+    records = records[complete][:-(-total_bits // max_block_bits)]
+    channel_idx, bitplane_idx, by, bx, was_conjugated = records.T
 
-                        # Embed
-                        block[:, :] = data_arr
-                        payload_index += bits_to_embed
+    # Pixel coordinates of all blocks, shape (n, block_size, block_size)
+    offsets = np.arange(block_size)
+    rows = by[:, None, None] + offsets[:, None]
+    cols = bx[:, None, None] + offsets
 
-                        # Store record
-                        conj_map_records.append((channel_idx, bitplane_idx, by, bx, was_conjugated))
+    # Each used bitplane is read once and all of its blocks are gathered at once
+    blocks = np.empty((len(records), block_size, block_size), dtype=np.uint8)
+    for channel, plane in np.unique(records[:, :2], axis=0).tolist():
+        selected = np.flatnonzero((channel_idx == channel) & (bitplane_idx == plane))
+        bp = _bitplane(array_chw[channel], plane, cgc)
+        blocks[selected] = bp[rows[selected], cols[selected]]
+    blocks[was_conjugated.astype(bool)] ^= 1
 
-            # Reconstruct bitplane after changes
-            bitplanes[bitplane_idx] = bp
+    return BitBuffer.from_bits(blocks)[:total_bits]
 
-        # Rebuild the channel from the modified bitplanes
-        array_chw[channel_idx] = _reconstruct_from_bitplanes(bitplanes)
 
-    used_bits = payload_index
+def _ordered_map(executor, function, items, window):
+    """
+    Lazily maps function over items, in order. With an executor, up to `window` further calls run ahead
+    concurrently, so that stopping early does not compute all items.
+    """
+    if executor is None:
+        yield from map(function, items)
+        return
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) > window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _data_blocks(bits, n_blocks, block_size, threshold, embedded_map):
+    """
+    Arranges payload bits into n_blocks blocks and conjugates the blocks that are not complex.
+    The last block is zero-padded.
 
-    # Re-shape back (H,W,C)
-    array_3d = np.transpose(array_chw, (1, 2, 0))
-    if array_3d.shape[2] == 1:
-        # squeeze to (H,W) if grayscale
-        array_3d = np.squeeze(array_3d, axis=2)
+    :return: data blocks (n_blocks, block_size, block_size) and the conjugation flags (n_blocks,)
+    """
+    max_bits = block_size * block_size
+    block_capacity = max_bits - 1 if embedded_map else max_bits
+    chunk = np.zeros(n_blocks * block_capacity, dtype=np.uint8)
+    chunk[:len(bits)] = bits
+    data_arr = np.zeros((n_blocks, max_bits), dtype=np.uint8)
+    data_arr[:, max_bits - block_capacity:] = chunk.reshape(-1, block_capacity)
+    data_arr = data_arr.reshape((-1, block_size, block_size))
+
+    # Check complexity of the data blocks
+    was_conjugated = _compute_complexity(data_arr) < threshold
+    if embedded_map:
+        data_arr[was_conjugated] ^= _checkerboard(block_size)
+        data_arr[was_conjugated, 0, 0] = 1
+    else:
+        data_arr[was_conjugated] ^= 1
+    return data_arr, was_conjugated
 
-    return array_3d.astype(np.uint8), conj_map_records, used_bits
 
-def extract(array,conj_map_records,total_bits,block_size = 8):
+def _records(channel_idx, bitplane_idx, chosen, was_conjugated, block_size):
     """
-    Generalized BPCS extraction. 
-    conj_map_records = [(channel_idx, bitplane_idx, by, bx, was_conjugated), ...]
-    Returns binary string of length total_bits.
+    Conjugation map records of the chosen blocks of a bitplane.
     """
-    #make 3d
-    if array.ndim == 2:
-        array_3d = array[:, :, np.newaxis]
-    else:
-        array_3d = array
+    records = np.empty(len(chosen), dtype=CONJ_MAP_DTYPE)
+    records['channel'] = channel_idx
+    records['bitplane'] = bitplane_idx
+    records['by'] = chosen[:, 0] * block_size
+    records['bx'] = chosen[:, 1] * block_size
+    records['conjugated'] = was_conjugated
+    return records
 
-    H, W, C = array_3d.shape
-    array_chw = np.transpose(array_3d, (2, 0, 1))
 
-    extracted_bits = []
-    bits_collected = 0
+def _extract_embedded_map(array_chw, total_bits, block_size, threshold, cgc=False):
+    """
+    Extraction for embedded_map: the used blocks are the complex blocks in scan order,
+    and the first bit of each block is its conjugation flag.
+    """
+    block_capacity = block_size * block_size - 1
+    needed_blocks = -(-total_bits // block_capacity)
+    collected = []
+    n_collected = 0
+
+    for channel_data in array_chw:
+        for bitplane_idx in range(array_chw.dtype.itemsize * 8):
+            if n_collected >= needed_blocks:
+                break
+            blocks = _blocks(_bitplane(channel_data, bitplane_idx, cgc), block_size)
+            chosen = np.argwhere(_compute_complexity(blocks) >= threshold)[:needed_blocks - n_collected]
+            data_arr = blocks[chosen[:, 0], chosen[:, 1]]
+            data_arr[data_arr[:, 0, 0] == 1] ^= _checkerboard(block_size)
+            collected.append(data_arr.reshape(len(chosen), -1)[:, 1:])
+            n_collected += len(chosen)
 
-    for (channel_idx, bitplane_idx, by, bx, was_conjugated) in conj_map_records:
-        if bits_collected >= total_bits:
-            break
+    if not collected:
+        return BitBuffer()
+    return BitBuffer.from_bits(np.concatenate(collected))[:total_bits]
 
-        channel_data = array_chw[channel_idx]
-        bitplanes = _split_into_bitplanes(channel_data)
-        bp = bitplanes[bitplane_idx]
 
-        block = bp[by:by+block_size, bx:bx+block_size]
-        if block.shape != (block_size, block_size):
-            continue
+def _records_to_array(conj_map_records):
+    """
+    Conjugation map as an integer array (n, 5) of (channel_idx, bitplane_idx, by, bx, was_conjugated).
+    """
+    if isinstance(conj_map_records, np.ndarray) and conj_map_records.dtype.names:
+        return np.column_stack([conj_map_records[name].astype(np.int64)
+                                for name in conj_map_records.dtype.names]).reshape(-1, 5)
+    return np.array(conj_map_records, dtype=np.int64).reshape(-1, 5)
 
-        flat_block = block.ravel()
-        if was_conjugated:
-            flat_block = 1 - flat_block
 
-        max_block_bits = block_size * block_size
-        needed_bits = min(max_block_bits, total_bits - bits_collected)
+def _check_embedded_threshold(block_size, threshold):
+    """
+    With an embedded map, conjugated blocks have a complexity of at least 1 - threshold - 2/max_transitions,
+    which must not fall below the threshold.
+    """
+    max_transitions = 2 * block_size * (block_size - 1)
+    if block_size < 2 or threshold > 0.5 - 1 / max_transitions:
+        raise ValueError(f'embedded_map requires block_size >= 2 and threshold <= {0.5 - 1 / max_transitions:.4f}.')
 
-        extracted_bits.extend(flat_block[:needed_bits].tolist())
-        bits_collected += needed_bits
 
-    extracted_bin = ''.join(str(bit) for bit in extracted_bits)
-    return extracted_bin[:total_bits]
+def _checkerboard(block_size):
+    """
+    Conjugation pattern Wc of the original scheme, with a 0 in the top-left corner.
+    Conjugating a block with complexity a gives complexity 1 - a.
+    """
+    offsets = np.arange(block_size)
+    return ((offsets[:, None] + offsets) % 2).astype(np.uint8)
 
 
-def _split_into_bitplanes(channel_data: np.ndarray):
+def _to_gray(channel_data):
     """
-    Split a single-channel 8-bit image (H,W) into a list of 8 bitplanes [0..7].
-    bitplane[0] = LSB, bitplane[7] = MSB.
+    Converts unsigned values to Canonical Gray Code in place.
     """
-    bitplanes = []
-    for b in range(8):
-        bp = (channel_data >> b) & 1
-        bitplanes.append(bp.astype(np.int32))
-    return bitplanes
+    channel_data ^= channel_data >> 1
 
 
-def _reconstruct_from_bitplanes(bitplanes):
+def _from_gray(channel_data):
     """
-    Reconstruct a single-channel 8-bit image from a list of 8 bitplanes.
-    bitplane[0] = LSB, bitplane[7] = MSB.
+    Converts unsigned values from Canonical Gray Code back to pure binary in place.
+    Uses log2(bit width) shifts, each bit becomes the XOR of all higher Gray code bits.
     """
-    channel_data = np.zeros_like(bitplanes[0], dtype=np.uint8)
-    for b in range(8):
-        channel_data |= (bitplanes[b].astype(np.uint8) << b)
-    return channel_data
+    shift = 1
+    while shift < channel_data.dtype.itemsize * 8:
+        channel_data ^= channel_data >> shift
+        shift *= 2
 
 
-def _compute_complexity(block: np.ndarray):
+def _bitplane(channel_data, bitplane_idx, cgc=False):
     """
-    Simple complexity measure: count 0->1 or 1->0 transitions in horizontal + vertical directions.
-    Returns a float in [0,1].
+    Bitplane (H,W) of a single-channel image of unsigned values as a uint8 array of 0/1.
+    bitplane 0 = LSB. With cgc, the bitplane of the Gray code of the values.
     """
-    h, w = block.shape
-    transitions = 0
+    plane = np.right_shift(channel_data, bitplane_idx, dtype=channel_data.dtype)
+    if cgc:
+        # Gray code bit b is the XOR of the bits b and b+1
+        plane ^= plane >> 1
+    plane &= 1
+    return plane.astype(np.uint8, copy=False)
+
 
-    # Horizontal transitions
-    for row in range(h):
-        for col in range(w - 1):
-            if block[row, col] != block[row, col + 1]:
-                transitions += 1
+def _write_blocks(channel_data, bitplane_idx, positions, data, block_size):
+    """
+    Writes blocks of bits into one bitplane of a channel, in place.
 
-    # Vertical transitions
-    for col in range(w):
-        for row in range(h - 1):
-            if block[row, col] != block[row + 1, col]:
-                transitions += 1
+    :param channel_data: single-channel image (H,W), may be a view.
+    :param positions: block coordinates (n, 2) as (block row, block column).
+    :param data: bits of the blocks, shape (n, block_size, block_size).
+    """
+    channel_blocks = _blocks(channel_data, block_size)
+    rows, cols = positions[:, 0], positions[:, 1]
+    bit = channel_data.dtype.type(1 << bitplane_idx)
+    values = channel_blocks[rows, cols] & ~bit
+    values |= data.astype(channel_data.dtype) << bitplane_idx
+    channel_blocks[rows, cols] = values
+
+
+def _blocks(bitplane, block_size):
+    """
+    View of the complete blocks of a bitplane or channel (H,W) as an array (nBy, nBx, block_size, block_size).
+    Writing to the view writes to the bitplane.
+    """
+    H, W = bitplane.shape
+    nBy, nBx = H // block_size, W // block_size
+    cropped = bitplane[:nBy * block_size, :nBx * block_size]
+    return cropped.reshape(nBy, block_size, nBx, block_size).swapaxes(1, 2)
+
+
+def _compute_complexity(blocks: np.ndarray):
+    """
+    Simple complexity measure: count 0->1 or 1->0 transitions in horizontal + vertical directions.
+    Vectorized over all leading axes, e.g. blocks of shape (nBy, nBx, h, w).
+    Returns floats in [0,1].
+    """
+    h, w = blocks.shape[-2:]
+    # Horizontal and vertical transitions, XOR of neighbours
+    transitions = (np.count_nonzero(blocks[..., :, 1:] != blocks[..., :, :-1], axis=(-2, -1)) +
+                   np.count_nonzero(blocks[..., 1:, :] != blocks[..., :-1, :], axis=(-2, -1)))
 
     max_transitions = (h * (w - 1)) + (w * (h - 1))
-    return transitions / max_transitions if max_transitions > 0 else 0
+    if max_transitions == 0:
+        return np.zeros(blocks.shape[:-2])
+    return transitions / max_transitions
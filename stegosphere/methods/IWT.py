@@ -1,5 +1,13 @@
-import numpy as np
+import itertools
 import warnings
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from stegosphere import io
+from stegosphere import utils
+from stegosphere.config import METADATA_LENGTH_IWT, DELIMITER_MESSAGE
+from stegosphere.methods import LSB
 
 MODE_DISCARD = 'discard'
 MODE_SYMMETRIC = 'symmetric'
@@ -9,6 +17,85 @@ MODE_WRAP = 'wrap'
 
 SUPPORTED_PAD_MODES = [MODE_DISCARD,MODE_SYMMETRIC,MODE_REFLECT,MODE_EDGE,MODE_WRAP]
 
+EMBED_LSB = 'lsb'
+EMBED_DE = 'de'
+
+#Number of values read at once by transform_tiled and inverse_tiled
+TILE_SIZE = 1 << 22
+
+class Coefficients(MutableMapping):
+    """
+    Wavelet coefficients of a transform, stored in a single array in Mallat layout: along every transformed axis,
+    the first half holds the approximation and the second half the detail coefficients.
+
+    Behaves like a dictionary of the subbands, keyed by tuples of '0' (approximation) and '1' (detail), one per
+    transformed axis. The subbands are views into the array, assigning to a subband writes into it.
+    """
+    def __init__(self, array, n_axes):
+        """
+        :param array: Coefficients in Mallat layout, with even lengths along the transformed axes.
+        :type array: np.ndarray
+        :param n_axes: Number of transformed (leading) axes.
+        :type n_axes: int
+        """
+        self.array = array
+        self.n_axes = n_axes
+
+    def _slices(self, key):
+        try:
+            key = tuple(key)
+        except TypeError:
+            raise KeyError(key) from None
+        if len(key) != self.n_axes or not set(key) <= {'0', '1'}:
+            raise KeyError(key)
+        return tuple(slice(None, length // 2) if band == '0' else slice(length // 2, None)
+                     for band, length in zip(key, self.array.shape))
+
+    def __getitem__(self, key):
+        return self.array[self._slices(key)]
+
+    def __setitem__(self, key, value):
+        subband = self[key]
+        value = np.asarray(value)
+        if value.shape != subband.shape:
+            raise ValueError(f'Subband {key} has shape {subband.shape}, got {value.shape}.')
+        subband[...] = value
+
+    def __delitem__(self, key):
+        raise TypeError('Subbands cannot be removed.')
+
+    def __iter__(self):
+        return itertools.product('01', repeat=self.n_axes)
+
+    def __len__(self):
+        return 1 << self.n_axes
+
+    def __repr__(self):
+        return f'Coefficients(shape={self.array.shape}, dtype={self.array.dtype}, n_axes={self.n_axes})'
+
+    def copy(self):
+        return Coefficients(self.array.copy(), self.n_axes)
+
+    @classmethod
+    def from_dict(cls, coeffs):
+        """
+        Creates Coefficients from a dictionary of subbands.
+        """
+        try:
+            n_axes = len(next(iter(coeffs)))
+        except StopIteration:
+            raise ValueError('Coefficients dictionary is empty.') from None
+        approx = np.asarray(coeffs[('0',) * n_axes])
+        shape = tuple(length * 2 for length in approx.shape[:n_axes]) + approx.shape[n_axes:]
+        dtype = np.result_type(*(np.asarray(value).dtype for value in coeffs.values()))
+        result = cls(np.empty(shape, dtype=dtype), n_axes)
+        for key in result:
+            if key not in coeffs:
+                raise ValueError(f'Missing subband {key}.')
+            result[key] = coeffs[key]
+        return result
+
+
 def transform(array, skip_last_axis=False, boundary_mode=MODE_DISCARD):
     """
     Transform data into wavelet domain using the Integer Haar Wavelet Transform.
@@ -22,7 +109,7 @@ def transform(array, skip_last_axis=False, boundary_mode=MODE_DISCARD):
                         - 'symmetric'/'reflect'/'edge'/'wrap': use np.pad to make dimensions even,
                         and remove padding after inverse transform
     :return: A tupling containing:
-                        - dictionary with wavelet coefficients
+                        - Coefficients, a dictionary-like view of the wavelet coefficients
                         - information needed for the inverse transform
     """
     
@@ -30,31 +117,35 @@ def transform(array, skip_last_axis=False, boundary_mode=MODE_DISCARD):
         raise TypeError('array must be a numpy ndarray')
 
     boundary_info = {'mode': boundary_mode}
+    n_axes = _n_axes(array, skip_last_axis)
+    dtype = _coefficient_dtype(array.dtype, n_axes)
 
     if boundary_mode == MODE_DISCARD:
-        processed_array, removed_elements = _adjust_for_uneven_lengths(array, skip_last_axis)
+        processed_array, removed_elements = _adjust_for_uneven_lengths(array.astype(dtype), skip_last_axis)
         boundary_info['details'] = removed_elements # Store removed slices
     elif boundary_mode in SUPPORTED_PAD_MODES:
         warnings.warn('boundary modes other than discard are not stable yet.')
-        processed_array, padded_axes = _pad_for_even_lengths(array, skip_last_axis, boundary_mode)
+        processed_array, padded_axes = _pad_for_even_lengths(array.astype(dtype, copy=False), skip_last_axis, boundary_mode)
         boundary_info['details'] = padded_axes # Store which axes were padded
     else:
         raise ValueError('unsupported boundary mode')
 
-    coeffs = _iwt_nd(processed_array, skip_last_axis)
-    return coeffs, boundary_info
+    _iwt_nd(processed_array, n_axes)
+    return Coefficients(processed_array, n_axes), boundary_info
 
 def inverse(coeffs, boundary_info):
     """
     Inverse transform data from wavelet domain into spatial domain using teh Integer Haar Wavelet Transform.
 
-    :param coeffs: Dictionary with wavelet coefficients from the transform function
+    :param coeffs: Coefficients from the transform function, or a dictionary of subbands
     :param boundary_info: Dictionary containing the boundary handling information as returned by the transform function
 
     :return: Reconstructed numpy array
     """
-    if not isinstance(coeffs, dict):
-        raise TypeError('coeffs must be a dictionary.')
+    if isinstance(coeffs, dict):
+        coeffs = Coefficients.from_dict(coeffs)
+    if not isinstance(coeffs, Coefficients):
+        raise TypeError('coeffs must be Coefficients or a dictionary.')
     if not isinstance(boundary_info, dict):
         raise TypeError('boundary_info must be a dictionary.')
     if 'mode' not in boundary_info or 'details' not in boundary_info:
@@ -63,7 +154,8 @@ def inverse(coeffs, boundary_info):
     mode = boundary_info['mode']
     details = boundary_info['details']
 
-    reconstructed_processed_array = _iiwt_nd(coeffs)
+    reconstructed_processed_array = coeffs.array.copy()
+    _iiwt_nd(reconstructed_processed_array, coeffs.n_axes)
     if mode == MODE_DISCARD:
         #details contain the removed slices
         final_array = _restore_uneven_lengths(reconstructed_processed_array, details)
@@ -73,9 +165,331 @@ def inverse(coeffs, boundary_info):
     return final_array
 
 
+def transform_tiled(array, out=None, skip_last_axis=False, tile_size=TILE_SIZE):
+    """
+    Transform data into wavelet domain in tiles, for arrays that do not fit into memory such as np.memmap.
+    The Haar transform has no dependencies between blocks of even length, so the array is processed in slabs of an
+    even number of indices along the first axis. Every slab is read, transformed and written into out on its own.
+    Uneven dimensions are handled as in discard mode: the last slice is not transformed and copied into out.
+
+    :param array: input numpy array
+    :param out: Array of the same shape to write the coefficients into, e.g. a np.memmap. Its dtype has to be a signed
+                integer dtype holding the coefficients, which need one bit more per transformed axis than the input.
+                Defaults to a new in-memory array of the smallest such dtype, so for data larger than memory,
+                out has to be given, e.g. as a np.memmap.
+    :param skip_last_axis: If True, the transformation is not applied along the last axis. Recommended for colour images.
+    :param tile_size: Approximate number of values per slab.
+    :return: Coefficients of the transformed region and boundary_info as returned by transform, both views into out.
+             out holds all of them, so inverse_tiled(out, ...) or inverse(coefficients, boundary_info) invert it.
+    """
+    n_axes = _n_axes(array, skip_last_axis)
+    dtype = _coefficient_dtype(array.dtype, n_axes)
+    out = _prepare_tiled_out(array, out, dtype)
+    if not np.issubdtype(out.dtype, np.signedinteger) or not np.can_cast(dtype, out.dtype):
+        raise ValueError(f'out must have a signed integer dtype holding {dtype}, got {out.dtype}.')
+    region = _even_region(array.shape, n_axes)
+    _copy_remainder(array, out, n_axes)
+    _, removed_elements = _adjust_for_uneven_lengths(out, skip_last_axis)
+    boundary_info = {'mode': MODE_DISCARD, 'details': removed_elements}
+    if n_axes == 0:
+        np.copyto(out, array, casting='unsafe')
+        return Coefficients(out, 0), boundary_info
+
+    half = region[0].stop // 2
+    for start, stop, tile in _tiles(array.shape, region, out.dtype, tile_size):
+        np.copyto(tile, array[(slice(start, stop),) + region[1:]], casting='unsafe')
+        _iwt_nd(tile, n_axes)
+        rows = (stop - start) // 2
+        out[(slice(start // 2, stop // 2),) + region[1:]] = tile[:rows]
+        out[(slice(half + start // 2, half + stop // 2),) + region[1:]] = tile[rows:]
+    return Coefficients(out[region], n_axes), boundary_info
+
+def inverse_tiled(array, out, skip_last_axis=False, tile_size=TILE_SIZE):
+    """
+    Inverse of transform_tiled, in tiles.
+    If the reconstructed values do not fit into out, OverflowError is raised before anything is written. This
+    needs a first pass over all tiles, which is skipped if out can hold any reconstructed value.
+
+    :param array: The coefficients, the array written by transform_tiled
+    :param out: Array of the same shape to write the reconstructed data into, e.g. a np.memmap
+    :param skip_last_axis: Whether the last axis was skipped by the transform
+    :param tile_size: Approximate number of values per slab.
+    :return: out
+    """
+    n_axes = _n_axes(array, skip_last_axis)
+    out = _prepare_tiled_out(array, out, None)
+    region = _even_region(array.shape, n_axes)
+    check = np.issubdtype(out.dtype, np.integer) and not np.can_cast(array.dtype, out.dtype)
+    if n_axes == 0:
+        if check:
+            _check_bounds(array, out.dtype)
+        np.copyto(out, array, casting='unsafe')
+        return out
+
+    if check:
+        for remainder in _remainders(array, n_axes):
+            _check_bounds(remainder, out.dtype)
+        for _, _, tile in _inverse_tiles(array, region, n_axes, tile_size):
+            _check_bounds(tile, out.dtype)
+    _copy_remainder(array, out, n_axes)
+    for start, stop, tile in _inverse_tiles(array, region, n_axes, tile_size):
+        np.copyto(out[(slice(start, stop),) + region[1:]], tile, casting='unsafe')
+    return out
+
+
+def embed(array, payload, levels=1, subbands=None, mode=EMBED_LSB, bits=1, matching=False, threshold=2,
+          seed=None, method='metadata', metadata_length=METADATA_LENGTH_IWT,
+          delimiter_message=DELIMITER_MESSAGE, compress=False, skip_last_axis=False, out=None):
+    """
+    Encodes a message into the detail coefficients of the Integer Haar Wavelet Transform.
+
+    The array is decomposed into `levels` levels, each level transforming the approximation band of the previous one.
+    The payload is written into the selected detail subbands of all levels, starting with the deepest level.
+    Values within the maximal change of the embedding of the dtype limits are clipped first, so that the
+    stego values always fit into the dtype.
+
+    :param array: The array to write the payload into.
+    :type array: np.ndarray
+    :param payload: The payload to be hidden. Gets converted into binary if not already.
+    :type payload: str, bytes, BitBuffer
+    :param levels: Number of decomposition levels. Defaults to 1.
+    :type levels: int, optional
+    :param subbands: Keys of the detail subbands to embed into, e.g. [('1','1')] for the diagonal details of an image.
+                     Used on every level. Defaults to all detail subbands.
+    :type subbands: list, optional
+    :param mode: 'lsb' to embed into the LSBs of the coefficients (see LSB.embed), or 'de' for difference expansion:
+                 coefficients c with abs(c) <= threshold are expanded to 2c+bit, larger ones are shifted by threshold+1.
+                 Defaults to 'lsb'.
+    :type mode: str, optional
+    :param bits: Number of bits per coefficient if mode='lsb'. Defaults to 1.
+    :type bits: int, optional
+    :param matching: Whether to use LSB matching if mode='lsb', see LSB.embed. Defaults to False.
+    :type matching: bool, int, optional
+    :param threshold: Largest absolute coefficient that is expanded if mode='de'. Defaults to 2.
+    :type threshold: int, optional
+    :param seed: (Optional) Seed value for pseudo-randomly distributing the message in the coefficients.
+    :type seed: int, optional
+    :param method: Method for marking the end of the message. Options are 'delimiter', 'metadata', or None. Defaults to 'metadata'.
+    :type method: str, optional
+    :param metadata_length: Length of the metadata in bits when `method='metadata'`. Defaults to `METADATA_LENGTH_IWT`.
+    :type metadata_length: int, optional
+    :param delimiter_message: The delimiter string used when `method='delimiter'`.
+    :type delimiter_message: str, optional
+    :param compress: Whether to use compression on the input data. Defaults to False.
+    :type compress: bool, optional
+    :param skip_last_axis: If True, the transformation is not applied along the last axis. Recommended for colour images.
+    :type skip_last_axis: bool, optional
+    :param out: Array to write the result into, e.g. a np.memmap. Use `out=array` to embed in place.
+                Defaults to a new array.
+    :type out: np.ndarray, optional
+
+    :return: The array with the embedded payload.
+    :rtype: np.ndarray
+    """
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError('Array must have an integer dtype for IWT embedding.')
+    subbands = _subbands(array, subbands, skip_last_axis)
+    if mode == EMBED_LSB:
+        #0 is a valid matching seed
+        matched = matching is not None and matching is not False
+        max_change = (1 << (bits - 1)) if matched else (1 << bits) - 1
+    elif mode == EMBED_DE:
+        if threshold < 0:
+            raise ValueError('threshold must not be negative.')
+        max_change = threshold + 1
+    else:
+        raise ValueError(f'Invalid mode: {mode}')
+
+    #clipping by the largest possible change of a value keeps the inverse transform within the dtype
+    n_axes = _n_axes(array, skip_last_axis)
+    margin = _change_bound(levels, n_axes, subbands, max_change)
+    min_value, max_value = utils.dtype_range(array.dtype)
+    if 2 * margin > int(max_value) - int(min_value):
+        raise ValueError(f'{array.dtype} is too small for the change of the embedding.')
+    buffer = np.empty(array.shape, dtype=_coefficient_dtype(array.dtype, n_axes))
+    np.clip(array, min_value + margin, max_value - margin, out=buffer)
+
+    decomposition = _decompose(buffer, levels, n_axes)
+    coefficients = _gather_subbands(decomposition, subbands)
+    if mode == EMBED_LSB:
+        LSB.embed(coefficients, payload, matching=matching, seed=seed, bits=bits, method=method,
+                  metadata_length=metadata_length, delimiter_message=delimiter_message,
+                  compress=compress, out=coefficients)
+    else:
+        payload = io.encode_payload(payload, method, metadata_length, delimiter_message, compress)
+        _expand(coefficients, payload, threshold, seed)
+    _scatter_subbands(decomposition, subbands, coefficients)
+    _recompose(decomposition)
+
+    if buffer.size and (buffer.min() < min_value or buffer.max() > max_value):
+        raise OverflowError(f'Embedded values do not fit into {array.dtype}.')
+    if out is None:
+        out = np.empty_like(array)
+    elif out.shape != array.shape or out.dtype != array.dtype:
+        raise ValueError('out must have the same shape and dtype as array.')
+    np.copyto(out, buffer, casting='unsafe')
+    return out
+
+
+def extract(array, levels=1, subbands=None, mode=EMBED_LSB, bits=1, threshold=2, seed=None,
+            method='metadata', n_bits=100, metadata_length=METADATA_LENGTH_IWT,
+            delimiter_message=DELIMITER_MESSAGE, compress=False, skip_last_axis=False):
+    """
+    Decodes a message from the detail coefficients of the Integer Haar Wavelet Transform.
+    The parameters have to match those used for embedding.
+
+    :param levels: Number of decomposition levels.
+    :param subbands: Keys of the detail subbands holding the message.
+    :param mode: 'lsb' or 'de', see embed.
+    :param bits: Number of bits per coefficient if mode='lsb'.
+    :param threshold: Threshold of the difference expansion if mode='de'.
+    :param seed: Seed value for pseudo-randomly distributing the message in the coefficients.
+    :param method: Method for marking the end of the message: 'delimiter', 'metadata', or None.
+    :param n_bits: Bits to be read if method=None.
+    :param metadata_length: Length of the metadata in bits if method='metadata'.
+    :param delimiter_message: Delimiter used if method='delimiter'.
+    :param compress: Whether compression was used on the encoded data.
+    :param skip_last_axis: Whether the last axis was skipped by the transform.
+    :return: The decoded message bits.
+    :rtype: BitBuffer
+    """
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError('Array must have an integer dtype for IWT extraction.')
+    subbands = _subbands(array, subbands, skip_last_axis)
+    n_axes = _n_axes(array, skip_last_axis)
+    buffer = array.astype(_coefficient_dtype(array.dtype, n_axes))
+    coefficients = _gather_subbands(_decompose(buffer, levels, n_axes), subbands)
+    if mode == EMBED_LSB:
+        return LSB.extract(coefficients, seed=seed, bits=bits, method=method, n_bits=n_bits,
+                           metadata_length=metadata_length, delimiter_message=delimiter_message,
+                           compress=compress)
+    if mode != EMBED_DE:
+        raise ValueError(f'Invalid mode: {mode}')
+    if seed is not None:
+        coefficients = coefficients[utils.prng_indices(coefficients.size, seed)]
+    #expanded coefficients lie within [-2*threshold, 2*threshold+1], shifted ones outside, and hold the bit in their LSB
+    carriers = coefficients[np.abs(coefficients) <= 2 * threshold + 1]
+    return LSB.extract(carriers, method=method, n_bits=n_bits, metadata_length=metadata_length,
+                       delimiter_message=delimiter_message, compress=compress)
+
+
+def _subbands(array, subbands, skip_last_axis):
+    """
+    Validates the detail subband keys, defaulting to all detail subbands.
+    """
+    n_axes = _n_axes(array, skip_last_axis)
+    if subbands is None:
+        return [key for key in itertools.product('01', repeat=n_axes) if '1' in key]
+    subbands = [tuple(key) for key in subbands]
+    for key in subbands:
+        if len(key) != n_axes or not set(key) <= {'0', '1'}:
+            raise ValueError(f'Invalid subband {key} for {n_axes} transformed axes.')
+        if '1' not in key:
+            raise ValueError('The approximation band cannot be used for embedding.')
+    if not subbands:
+        raise ValueError('At least one subband is needed.')
+    return subbands
+
+
+def _decompose(buffer, levels, n_axes):
+    """
+    Multi-level transform in place, the approximation band of every level is transformed again.
+    Odd last slices are left untransformed, as in discard mode.
+
+    :return: Coefficients of each level, first level first. Views into buffer.
+    :rtype: list
+    """
+    if levels < 1:
+        raise ValueError('levels must be at least 1.')
+    decomposition = []
+    region = buffer
+    for _ in range(levels):
+        region = region[tuple(slice(0, length - length % 2) for length in region.shape[:n_axes])]
+        _iwt_nd(region, n_axes)
+        coeffs = Coefficients(region, n_axes)
+        decomposition.append(coeffs)
+        region = coeffs[('0',) * n_axes]
+    return decomposition
+
+
+def _recompose(decomposition):
+    """
+    Inverse of _decompose, in place.
+    """
+    for coeffs in reversed(decomposition):
+        _iiwt_nd(coeffs.array, coeffs.n_axes)
+
+
+def _embedding_order(decomposition, subbands):
+    #the deepest level first
+    for coeffs in reversed(decomposition):
+        for key in subbands:
+            yield coeffs, key
+
+
+def _gather_subbands(decomposition, subbands):
+    """
+    Concatenates the coefficients of the subbands in embedding order.
+    """
+    parts = [coeffs[key].reshape(-1) for coeffs, key in _embedding_order(decomposition, subbands)]
+    return np.concatenate(parts).astype(np.int64, copy=False)
+
+
+def _scatter_subbands(decomposition, subbands, coefficients):
+    """
+    Inverse of _gather_subbands.
+    """
+    dtype = decomposition[0].array.dtype
+    if coefficients.size and (coefficients.min() < np.iinfo(dtype).min or coefficients.max() > np.iinfo(dtype).max):
+        raise OverflowError(f'Embedded coefficients do not fit into {dtype}.')
+    start = 0
+    for coeffs, key in _embedding_order(decomposition, subbands):
+        size = coeffs[key].size
+        coeffs[key] = coefficients[start:start + size].reshape(coeffs[key].shape)
+        start += size
+
+
+def _change_bound(levels, n_axes, subbands, max_change):
+    """
+    Largest change of a value after the inverse transform, if every coefficient of the subbands changes
+    by at most max_change. Inverting a step changes both values by at most approx change + ceil(detail change / 2).
+    """
+    bound = 0
+    for _ in range(levels):
+        changes = {key: (max_change if key in subbands else 0) for key in itertools.product('01', repeat=n_axes)}
+        changes[('0',) * n_axes] = bound
+        for _ in range(n_axes):
+            changes = {key[:-1]: changes[key[:-1] + ('0',)] + -(-changes[key[:-1] + ('1',)] // 2)
+                       for key in changes}
+        bound = changes[()]
+    return bound
+
+
+def _expand(coefficients, payload, threshold, seed=None):
+    """
+    Difference expansion of the coefficients, in place. Coefficients up to the last one holding the payload
+    are changed: expandable ones (abs(c) <= threshold) become 2c+bit, the others are shifted away from zero
+    by threshold+1, so that both remain distinguishable.
+    """
+    order = utils.prng_indices(coefficients.size, seed) if seed is not None else slice(None)
+    values = coefficients[order]
+    carriers = np.flatnonzero(np.abs(values) <= threshold)
+    if len(payload) > carriers.size:
+        warnings.warn('Insufficient bits, need larger cover or smaller message.')
+    carriers = carriers[:len(payload)]
+    if carriers.size == 0:
+        return
+    end = int(carriers[-1]) + 1
+    segment = values[:end]
+    segment += np.where(segment > threshold, threshold + 1, 0) - np.where(segment < -threshold, threshold + 1, 0)
+    segment[carriers] = 2 * segment[carriers] + payload.unpack()[:carriers.size]
+    if seed is not None:
+        coefficients[order[:end]] = segment
+
+
 def _adjust_for_uneven_lengths(array, skip_last_axis=False):
-    """adjusting for discard mode"""
-    adjusted_array = array.copy()
+    """adjusting for discard mode, returns views into array"""
+    adjusted_array = array
     removed_elements = {} # Store {axis: removed_slice_array}
 
     num_dims_to_process = array.ndim
@@ -98,7 +512,7 @@ def _adjust_for_uneven_lengths(array, skip_last_axis=False):
     return adjusted_array, removed_elements
 
 def _restore_uneven_lengths(array, removed_elements):
-    restored_array = array.copy()
+    restored_array = array
     if not removed_elements:
         return restored_array
     for axis in sorted(removed_elements.keys(), reverse=True):
@@ -114,7 +528,7 @@ def _restore_uneven_lengths(array, removed_elements):
 
 def _pad_for_even_lengths(array, skip_last_axis=False, pad_mode=MODE_SYMMETRIC):
     """padding uneven dimensions"""
-    padded_array = array.copy()
+    padded_array = array
     padded_axes = {} # Store {axis: pad_amount (always 1 here)}
 
     num_dims_to_process = array.ndim
@@ -128,7 +542,7 @@ def _pad_for_even_lengths(array, skip_last_axis=False, pad_mode=MODE_SYMMETRIC):
              padded_axes[axis] = 1 # Record axis and pad amount (1)
 
     if not axes_needing_padding:
-        return padded_array, padded_axes
+        return padded_array.copy(), padded_axes
 
     pad_width = [(0, 0)] * padded_array.ndim
     for axis in axes_needing_padding:
@@ -142,7 +556,7 @@ def _pad_for_even_lengths(array, skip_last_axis=False, pad_mode=MODE_SYMMETRIC):
 def _remove_padding(array, padded_axes):
     """remove padding"""
     if not padded_axes:
-        return array.copy()
+        return array
 
     slices = [slice(None)] * array.ndim
     for axis, pad_amount in padded_axes.items():
@@ -157,104 +571,157 @@ def _remove_padding(array, padded_axes):
     return array[tuple(slices)].copy()
 
 
-def _iwt_nd(array, skip_last_axis=False):
+def _n_axes(array, skip_last_axis=False):
+    """Number of transformed axes"""
+    if skip_last_axis and array.ndim > 0:
+        return array.ndim - 1
+    return array.ndim
+
+
+def _coefficient_dtype(dtype, n_axes):
     """
-    Integer Haar Wavelet Transform. Assumes even dimensions
+    Smallest signed integer dtype holding all coefficients of an array of the given dtype.
+    Approximations stay within the range of the input, every axis at most doubles the details.
     """
-    current_array = array.astype(np.int64)
-    coeffs = {(): current_array}
+    if not np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    info = np.iinfo(dtype)
+    largest = max(abs(int(info.min)), int(info.max)) << n_axes
+    for candidate in (np.int16, np.int32):
+        if largest <= np.iinfo(candidate).max:
+            return np.dtype(candidate)
+    return np.dtype(np.int64)
 
-    num_dims_to_process = array.ndim
-    axes_to_process = list(range(array.ndim))
-    if skip_last_axis and array.ndim > 0:
-        num_dims_to_process -= 1
-        axes_to_process = list(range(array.ndim - 1))
-
-    for axis in axes_to_process:
-         if array.shape[axis] % 2 != 0:
-              raise ValueError('dimension has to be even')
-
-    for axis in axes_to_process:
-        new_coeffs = {}
-        for key, arr_coeff in coeffs.items():
-            s = [slice(None)] * arr_coeff.ndim
-            s_even = s.copy(); s_even[axis] = slice(None, None, 2)
-            s_odd = s.copy(); s_odd[axis] = slice(1, None, 2)
-            arr_even = arr_coeff[tuple(s_even)]
-            arr_odd = arr_coeff[tuple(s_odd)]
-
-            approx = (arr_even + arr_odd) // 2
-            detail = arr_even - arr_odd
-
-            key_approx = key + ('0',)
-            key_detail = key + ('1',)
-            new_coeffs[key_approx] = approx
-            new_coeffs[key_detail] = detail
-        coeffs = new_coeffs
-
-    return coeffs
-
-def _iiwt_nd(coeffs):
-    """
-    Inverse Integer Haar Wavelet Transform. Assumes even dimensions
-    """
-    try:
-        first_key = next(iter(coeffs.keys()))
-        transformed_ndim = len(first_key)
-    except StopIteration:
-        if () in coeffs:
-            return coeffs[()].astype(np.int64)
-        else:
-            raise ValueError('Coefficients dictionary is non-empty but contains no keys.')
-
-    coeffs_inv = coeffs.copy()
-    axes_to_invert = list(range(transformed_ndim))
-
-    for axis in reversed(axes_to_invert):
-        new_coeffs = {}
-        processed_keys = set(k[:-1] for k in coeffs_inv.keys())
-
-        for key_prefix in processed_keys:
-            key_approx = key_prefix + ('0',)
-            key_detail = key_prefix + ('1',)
-
-            if key_approx not in coeffs_inv or key_detail not in coeffs_inv:
-                raise ValueError(f'Missing pair for key prefix {key_prefix}.')
-
-            approx = coeffs_inv[key_approx]
-            detail = coeffs_inv[key_detail]
-            current_ndim = approx.ndim
-
-            if detail.ndim != current_ndim:
-                 raise ValueError(f'Dimension mismatch between approx ({current_ndim}D) and detail ({detail.ndim}D) '
-                                  f'for key prefix {key_prefix}')
-            shape = list(approx.shape)
-            if axis >= len(shape):
-                 raise IndexError(f'Internal error: Axis index {axis} out of bounds for shape {approx.shape}.')
-
-            shape[axis] *= 2
-            arr = np.zeros(shape, dtype=np.int64)
-            s = [slice(None)] * current_ndim
-            s_even = s.copy(); s_even[axis] = slice(None, None, 2)
-            s_odd = s.copy(); s_odd[axis] = slice(1, None, 2)
-
-            #haar
-            arr_even = approx + ((detail + 1) // 2)
-            arr_odd = arr_even - detail
-
-            if arr[tuple(s_even)].shape != arr_even.shape:
-                 raise ValueError(f'Shape mismatch assigning even part for axis {axis}, key {key_prefix}. '
-                                  f'Target: {arr[tuple(s_even)].shape}, Source: {arr_even.shape}')
-            if arr[tuple(s_odd)].shape != arr_odd.shape:
-                 raise ValueError(f'Shape mismatch assigning odd part for axis {axis}, key {key_prefix}. '
-                                  f'Target: {arr[tuple(s_odd)].shape}, Source: {arr_odd.shape}')
-
-            arr[tuple(s_even)] = arr_even
-            arr[tuple(s_odd)] = arr_odd
-            new_coeffs[key_prefix] = arr
-        coeffs_inv = new_coeffs
-
-    if () not in coeffs_inv:
-         raise KeyError('Inverse transform failed: Final reconstructed array not found under key "()".')
-
-    return coeffs_inv[()].astype(np.int64)
+
+def _along(ndim, axis, index):
+    s = [slice(None)] * ndim
+    s[axis] = index
+    return tuple(s)
+
+
+def _chunks(half):
+    """
+    Chunks [start, stop) of the first half with stop <= 2*start+1, so that moving the values between
+    positions i and 2i+1 never overwrites a value that is still to be moved.
+    """
+    start = 0
+    while start < half:
+        stop = min(half, 2 * start + 1)
+        yield start, stop
+        start = stop
+
+
+def _even_region(shape, n_axes):
+    """Slices of the largest region with even lengths along the transformed axes"""
+    return tuple(slice(0, length - length % 2) for length in shape[:n_axes])
+
+
+def _copy_remainder(array, out, n_axes):
+    """Copies the last slices of uneven transformed axes, which are not transformed"""
+    for axis in range(n_axes):
+        if array.shape[axis] % 2:
+            index = _along(array.ndim, axis, slice(-1, None))
+            np.copyto(out[index], array[index], casting='unsafe')
+
+
+def _remainders(array, n_axes):
+    """Yields the last slices of uneven transformed axes"""
+    for axis in range(n_axes):
+        if array.shape[axis] % 2:
+            yield array[_along(array.ndim, axis, slice(-1, None))]
+
+
+def _check_bounds(values, dtype):
+    """Raises OverflowError if the values do not fit into dtype"""
+    bounds = utils.dtype_range(dtype)
+    if values.size and (values.min() < bounds[0] or values.max() > bounds[1]):
+        raise OverflowError(f'Reconstructed values do not fit into {dtype}.')
+
+
+def _prepare_tiled_out(array, out, dtype):
+    if out is None:
+        if dtype is None:
+            raise ValueError('out is required.')
+        return np.empty(array.shape, dtype=dtype)
+    if out.shape != array.shape:
+        raise ValueError('out must have the same shape as array.')
+    if np.may_share_memory(out, array):
+        raise ValueError('out must not overlap with array.')
+    return out
+
+
+def _tiles(shape, region, dtype, tile_size):
+    """
+    Yields start and stop along the first axis of every slab, and a buffer for it.
+    Slabs have an even length, the buffer is reused.
+    """
+    height = region[0].stop
+    slab_size = int(np.prod([s.stop for s in region[1:]] + list(shape[len(region):]), dtype=np.int64))
+    rows = max(2, tile_size // max(slab_size, 1) // 2 * 2)
+    buffer = np.empty((min(rows, height),) + tuple(s.stop for s in region[1:]) + tuple(shape[len(region):]),
+                      dtype=dtype)
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        yield start, stop, buffer[:stop - start]
+
+
+def _inverse_tiles(array, region, n_axes, tile_size):
+    """
+    Yields start and stop along the first axis of every slab of the transformed region, and its inverse transform.
+    The buffer is reused.
+    """
+    half = region[0].stop // 2
+    for start, stop, tile in _tiles(array.shape, region, array.dtype, tile_size):
+        rows = (stop - start) // 2
+        tile[:rows] = array[(slice(start // 2, stop // 2),) + region[1:]]
+        tile[rows:] = array[(slice(half + start // 2, half + stop // 2),) + region[1:]]
+        _iiwt_nd(tile, n_axes)
+        yield start, stop, tile
+
+
+def _iwt_nd(array, n_axes):
+    """
+    Integer Haar Wavelet Transform of the first n_axes axes, in place, by lifting.
+    Assumes even dimensions. The result is in Mallat layout, see Coefficients.
+    """
+    scratch = np.empty(array.size // 2, dtype=array.dtype)
+    for axis in range(n_axes):
+        half = array.shape[axis] // 2
+        even = array[_along(array.ndim, axis, slice(0, None, 2))]
+        odd = array[_along(array.ndim, axis, slice(1, None, 2))]
+        temp = scratch[:even.size].reshape(even.shape)
+
+        #detail = even - odd, approx = odd + detail//2 = (even + odd)//2
+        np.subtract(even, odd, out=even)
+        np.right_shift(even, 1, out=temp)
+        np.add(odd, temp, out=odd)
+
+        #approximations into the first half, details into the second
+        np.copyto(temp, even)
+        for start, stop in _chunks(half):
+            np.copyto(array[_along(array.ndim, axis, slice(start, stop))],
+                      array[_along(array.ndim, axis, slice(2 * start + 1, 2 * stop, 2))])
+        np.copyto(array[_along(array.ndim, axis, slice(half, None))], temp)
+
+
+def _iiwt_nd(array, n_axes):
+    """
+    Inverse Integer Haar Wavelet Transform of the first n_axes axes, in place. Assumes even dimensions.
+    """
+    scratch = np.empty(array.size // 2, dtype=array.dtype)
+    for axis in reversed(range(n_axes)):
+        half = array.shape[axis] // 2
+        even = array[_along(array.ndim, axis, slice(0, None, 2))]
+        odd = array[_along(array.ndim, axis, slice(1, None, 2))]
+        temp = scratch[:even.size].reshape(even.shape)
+
+        np.copyto(temp, array[_along(array.ndim, axis, slice(half, None))])
+        for start, stop in reversed(list(_chunks(half))):
+            np.copyto(array[_along(array.ndim, axis, slice(2 * start + 1, 2 * stop, 2))],
+                      array[_along(array.ndim, axis, slice(start, stop))])
+        np.copyto(even, temp)
+
+        #odd = approx - detail//2, even = detail + odd
+        np.right_shift(even, 1, out=temp)
+        np.subtract(odd, temp, out=odd)
+        np.add(even, odd, out=even)
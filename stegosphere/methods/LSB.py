@@ -1,5 +1,6 @@
 import warnings
 import ctypes
+import importlib.machinery
 import math
 import os
 
@@ -7,26 +8,79 @@ import numpy as np
 
 from stegosphere.config import METADATA_LENGTH_LSB, DELIMITER_MESSAGE
 from stegosphere import io
-from stegosphere.utils import prng_indices
+from stegosphere.bitbuffer import BitBuffer
+from stegosphere.tools import compression
+from stegosphere.utils import prng_indices, prepare_out, unsigned_view
 
+#Set to False to always use the NumPy implementation
 BACKEND = True
-try:
-    so_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend\\lsb.so")
-    backend = ctypes.CDLL(so_file_path)
-    backend.embed.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p,
-                              ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
-    backend.embed.restype = None
-    backend.extract.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
-                                ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int)]
-    backend.extract.restype = None
-    
-except Exception as e:
-    print(e)
+
+#Number of bits read first when searching a delimiter. Doubles for every further read.
+DELIMITER_WINDOW = 8192
+
+#Number of values passed to the native backend per call. Multiple of 8, so that chunks start at payload byte boundaries.
+CHUNK_SIZE = 1 << 20
+
+_BACKEND_ABI_VERSION = 4
+_backend = None
+_backend_loaded = False
+
+
+def _load_backend():
+    """
+    Loads the native backend on first use.
+
+    :return: The loaded library, or None if unavailable.
+    :rtype: ctypes.CDLL
+    """
+    global _backend, _backend_loaded
+    if _backend_loaded:
+        return _backend
+    _backend_loaded = True
+
+    backend_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend')
+    suffixes = tuple(importlib.machinery.EXTENSION_SUFFIXES) + ('.so', '.dll', '.dylib')
+    try:
+        candidates = [name for name in sorted(os.listdir(backend_dir))
+                      if name.startswith('lsb') and name.endswith(suffixes)]
+    except OSError:
+        candidates = []
+
+    for name in candidates:
+        try:
+            #CDLL releases the GIL during calls
+            library = ctypes.CDLL(os.path.join(backend_dir, name))
+        except OSError:
+            continue
+        if not hasattr(library, 'abi_version') or library.abi_version() != _BACKEND_ABI_VERSION:
+            continue
+        library.embed.argtypes = [ctypes.c_void_p, ctypes.c_int64, ctypes.c_void_p, ctypes.c_int64,
+                                  ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+        library.embed.restype = None
+        library.embed_matching.argtypes = [ctypes.c_void_p, ctypes.c_int64, ctypes.c_void_p, ctypes.c_int64,
+                                           ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                           ctypes.c_void_p]
+        library.embed_matching.restype = None
+        library.extract.argtypes = [ctypes.c_void_p, ctypes.c_int64, ctypes.c_int,
+                                    ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+        library.extract.restype = None
+        _backend = library
+        return _backend
+
     warnings.warn('C backend could not be loaded. Methods will use slower Python.')
-    BACKEND = False
+    return None
+
+
+def _get_backend(array):
+    """
+    Returns the native backend if it is enabled, available and supports the array.
+    """
+    if BACKEND is not True or array.dtype.itemsize not in (1, 2, 4, 8):
+        return None
+    return _load_backend()
 
 
-def max_capacity(array, bits = 1):
+def max_capacity(array, bits = 1, matrix=None):
     """
     Calculates the maximum capacity of the cover object for embedding a message.
 
@@ -34,15 +88,19 @@ def max_capacity(array, bits = 1):
 
     :param bits: Number of bits changed per value. Defaults to 1.
     :type bits: int
+    :param matrix: Parameter p of matrix embedding, see embed. Defaults to None.
+    :type matrix: int, optional
     :return: The maximum capacity of the object in bits.
     :rtype: int
     """
+    if matrix is not None:
+        return array.size // _block_length(matrix) * matrix
     return array.size * bits
 
 
 def embed(array, payload, matching=False, seed=None, bits=1,
                method='metadata', metadata_length=METADATA_LENGTH_LSB,
-               delimiter_message=DELIMITER_MESSAGE, compress=False):
+               delimiter_message=DELIMITER_MESSAGE, compress=False, out=None, matrix=None):
     """
     Encodes a message into the cover data using LSB steganography.
 
@@ -51,12 +109,15 @@ def embed(array, payload, matching=False, seed=None, bits=1,
     :param array: The array to write the payload into.
     :type array: np.ndarray
     :param payload: The payload to be hidden. Gets converted into binary if not already.
-    :type payload: str
-    :param matching: Whether to use LSB matching (not implemented yet). Defaults to False.
-    :type matching: bool, optional
+                    Binary file-like objects are read in chunks while embedding, without loading the whole file.
+    :type payload: str, bytes, BitBuffer, file-like object
+    :param matching: Whether to use LSB matching instead of replacement. Each value is changed to the closest value
+                     holding the payload bits, i.e. by ±1 for bits=1, with random direction where both are equally close.
+                     An int is used as seed for these random decisions. None is the same as False. Defaults to False.
+    :type matching: bool, int, optional
     :param seed: (Optional) Seed value for pseudo-randomly distributing the message in the cover data.
     :type seed: int, optional
-    :param bits: Number of bits used for decoding per value. Defaults to 1.
+    :param bits: Number of bits used for encoding per value, up to the bit width of the dtype. Defaults to 1.
     :type bits: int, optional
     :param method: Method for marking the end of the message. Options are 'delimiter', 'metadata', or None. Defaults to 'metadata'.
     :type method: str, optional
@@ -66,62 +127,72 @@ def embed(array, payload, matching=False, seed=None, bits=1,
     :type delimiter_message: str, optional
     :param compress: Whether to use compression on the input data. Defaults to False.
     :type compress: bool, optional
-
-    :raises NotImplementedError: If LSB matching is used.
-
-    :return: True, if it worked.
-    :rtype: bool
+    :param out: Array to write the result into, e.g. a np.memmap. Use `out=array` to embed in place.
+                Defaults to a copy of array.
+    :type out: np.ndarray, optional
+    :param matrix: Parameter p for matrix embedding with the Hamming code (1, 2^p-1, p): every block of 2^p-1 values
+                   holds p bits of the payload in the syndrome of its LSBs, with at most one changed value per block.
+                   Requires bits=1. Can be combined with matching. Defaults to None (no matrix embedding).
+    :type matrix: int, optional
+
+    :return: The array with the embedded payload.
+    :rtype: np.ndarray
     """
-    if matching is not False: raise NotImplementedError("LSB matching not implemented in current version.")
-    
-    payload = io.encode_payload(payload, method, metadata_length, delimiter_message, compress)
+    payload = io.encode_payload(payload, method, metadata_length, delimiter_message, compress, stream=True)
     
-    if len(payload) > max_capacity(array, bits):
+    if len(payload) > max_capacity(array, bits, matrix):
         warnings.warn("Insufficient bits, need larger cover or smaller message.")
 
-    orig_dim = array.shape
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError("Array must have an integer dtype for LSB embedding.")
+    _mask(bits, array.dtype)
+    generator = _matching_generator(matching)
+    out = prepare_out(array, out)
+
+    backend = _get_backend(out)
+    if not out.flags.c_contiguous:
+        backend = None
+    if matrix is not None:
+        if bits != 1:
+            raise ValueError("Matrix embedding requires bits=1.")
+        #the payload is replaced by the LSBs the used values must have, streamed payloads are read at once
+        n_blocks = min(math.ceil(len(payload) / matrix), out.size // _block_length(matrix))
+        lsbs = _read(out, backend, 1, 0, n_blocks * _block_length(matrix), seed)
+        payload = _matrix_encode(lsbs, _payload_chunk(payload, 0, len(payload)), matrix)
+
+    if backend is not None:
+        _native_embed(backend, out.reshape(-1), payload, bits, seed, generator)
 
-    if BACKEND is True:
-        content = array.flatten().copy()
-        payload = payload.encode('utf-8')
-        value_size = content.dtype.itemsize
-        array_pointer = content.ctypes.data_as(ctypes.c_void_p)
-
-        if seed is not None:
-            indices = prng_indices(content.size, seed)
-            indices_pointer = indices.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-        else:
-            indices_pointer = None
-        
-        backend.embed(array_pointer, content.size, payload, bits, value_size, indices_pointer)
-
-        
     else:
-        content = array.copy().flatten().astype(np.int32)
-        mask = (1<<bits)-1
-        payload_array = np.array([int(payload[i:i + bits], 2) for i in range(0, len(payload), bits)])
-        
-        payload_length = len(payload_array)
-        if seed:
-            indices = prng_indices(len(content),seed)[:payload_length]
-        else:
-            indices = np.arange(payload_length)
-        
-        content[indices[:payload_length]] &= ~mask
-        content[indices[:payload_length]] |= payload_array
-
-    content = content.reshape(orig_dim).astype(array.dtype)
-
-    return content
+        values = unsigned_view(out)
+        n_values = min(values.size, math.ceil(len(payload) / bits))
+        signed = np.issubdtype(out.dtype, np.signedinteger)
+        keep = ~_mask(bits, values.dtype)
+        for start in range(0, n_values, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_values)
+            chunk = _payload_chunk(payload, start * bits, min(len(payload) - start * bits, (stop - start) * bits))
+            payload_array = _bits_to_values(chunk, bits, values.dtype)
+            if seed is not None:
+                indices = _positions(start, stop, values.size, seed)
+            else:
+                indices = slice(start, stop)
+
+            if generator is not None:
+                coins = _random_bits(generator, stop - start)
+                _put(values, indices, _match(_take(values, indices), payload_array, bits, signed, coins))
+            else:
+                _put(values, indices, (_take(values, indices) & keep) | payload_array)
+
+    return out
 
 
 def extract(array, matching=False, seed=None, bits=1, method='metadata', n_bits=100, 
             metadata_length=METADATA_LENGTH_LSB, delimiter_message=DELIMITER_MESSAGE,
-            compress=False):
+            compress=False, max_read=None, matrix=None, sink=None):
     """
     Decodes a message from the cover data using LSB steganography.
 
-    :param matching: Whether to use LSB matching (not implemented yet).
+    :param matching: Whether LSB matching was used. Does not change extraction.
     :param seed: Seed value for pseudo-randomly distributing the message in the cover data.
     :param bits: Number of bits used for decoding per value.
     :param method: Method for marking the end of the message: 'delimiter', 'metadata', or None.
@@ -129,91 +200,88 @@ def extract(array, matching=False, seed=None, bits=1, method='metadata', n_bits=
     :param metadata_length: Length of the metadata in bits if method='metadata'.
     :param delimiter_message: Delimiter used if method='delimiter'.
     :param compress: Whether compression was used on the encoded data.
-    :return: The decoded message bits (or a final string if you decompress).
+    :param max_read: Maximum number of bits read while searching the delimiter if method='delimiter'. Defaults to the whole array.
+    :param matrix: Parameter p of matrix embedding, if used.
+    :param sink: Binary file-like object to write the message into as it is read, instead of returning it.
+                 Requires method='metadata' or None, without compression.
+    :return: The decoded message bits, or the number of bits written into sink.
+    :rtype: BitBuffer, int
     """
-    if matching:
-        raise NotImplementedError("LSB matching not implemented in current version.")
     assert method in ['metadata','delimiter', None]
-    content = array.copy().flatten()
-    
-    if seed is not None:
-        indices = prng_indices(len(content), seed)
-        indices_pointer = indices.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+    if not np.issubdtype(array.dtype, np.integer):
+        raise ValueError("Array must have an integer dtype for LSB extraction.")
+    content = array
+    backend = _get_backend(content) if content.flags.c_contiguous else None
+
+    #the payload is read in units: single values, or blocks of values with matrix embedding
+    if matrix is not None:
+        if bits != 1:
+            raise ValueError("Matrix embedding requires bits=1.")
+        block_length = _block_length(matrix)
+        unit_bits = matrix
+        n_units = content.size // block_length
     else:
-        indices = np.arange(len(content))
-        indices_pointer = None
-
-
-    def extract_bits_python(values, bits, indices_pointer=None):
-        mask = (1 << bits) - 1
-        return ''.join(f'{(v & mask):0{bits}b}' for v in values)
-
-    def extract_bits_c(values, bits, indices_pointer):
-        values_flat = values.ravel()
-        if not np.issubdtype(values_flat.dtype, np.integer):
-            raise ValueError("Array must have an integer dtype for LSB extraction.")
-        
-        values_cast = values_flat.astype(np.int64, copy=False)
+        unit_bits = bits
+        n_units = content.size
 
-        ptr = values_cast.ctypes.data_as(ctypes.c_void_p)
-        length = values_cast.size
-        elem_size = values_cast.dtype.itemsize
+    def read(start, stop):
+        #reads the bits of units start to stop
+        stop = min(stop, n_units)
+        start = min(start, stop)
+        if matrix is not None:
+            lsbs = _read(content, backend, 1, start * block_length, stop * block_length, seed)
+            return _matrix_decode(lsbs, matrix)
+        return _read(content, backend, bits, start, stop, seed)
 
-        total_bits = bits * length
-        out_buffer = ctypes.create_string_buffer(total_bits + 1)  # +1 for null terminator
-        
-        backend.extract(ptr, length, bits, elem_size, out_buffer, indices_pointer)
-        
-        return out_buffer.value.decode('utf-8')
-
-    if BACKEND is True:
-        backend_extract = extract_bits_c
-    else:
-        backend_extract = extract_bits_python
 
+    if sink is not None:
+        if method == 'delimiter' or compress:
+            raise ValueError("Writing into sink requires method='metadata' or None, without compression.")
+        return _extract_into(sink, read, n_units, unit_bits, method, n_bits, metadata_length,
+                             block_length if matrix is not None else 1)
 
-    message_bits = ""
+    message_bits = BitBuffer()
 
     if method is None:
         if n_bits is None:
-            n_bits = len(content) * bits
+            n_bits = n_units * unit_bits
         
-        needed_elems = math.ceil(n_bits / bits)
-        subset = content[indices[:needed_elems]]
-        
-        raw_bits = backend_extract(subset, bits, indices_pointer)
-        message_bits = raw_bits[:n_bits]
+        needed_elems = math.ceil(n_bits / unit_bits)
+        message_bits = read(0, needed_elems)[:n_bits]
 
     elif method == 'metadata':
-        total_metadata_pixels = math.ceil(metadata_length / bits)
-        metadata_subset = content[indices[:total_metadata_pixels]]
-        
-        metadata_raw = backend_extract(metadata_subset, bits, indices_pointer)
-        metadata_raw = metadata_raw[:metadata_length]
-        message_length = int(metadata_raw, 2)
+        total_metadata_pixels = math.ceil(metadata_length / unit_bits)
+        metadata_raw = read(0, total_metadata_pixels)
+        message_length = metadata_raw[:metadata_length].to_int()
         
-        total_message_pixels = math.ceil(message_length / bits)
-        message_subset = content[indices[total_metadata_pixels : total_metadata_pixels + total_message_pixels]]
-        
-        message_raw = backend_extract(message_subset, bits, indices_pointer)
-        message_bits = message_raw[:message_length]
+        #the message continues within the last metadata value if bits does not divide metadata_length
+        total_pixels = math.ceil((metadata_length + message_length) / unit_bits)
+        message_raw = metadata_raw + read(total_metadata_pixels, total_pixels)
+        message_bits = message_raw[metadata_length:metadata_length + message_length]
 
     elif method == 'delimiter':
-        if not io.is_binary(delimiter_message):
-            delimiter = io.data_to_binary(delimiter_message)
-        else:
-            delimiter = delimiter_message
-    
-        mask = (1 << bits) - 1
-
-        #not efficient for large arrays. replace with reading given amount of values before checking for delimiter
-        for idx in indices:
-            pixel_val = content[idx]
-            extracted_bits = f'{(pixel_val & mask):0{bits}b}'     
-            message_bits += extracted_bits
-            if message_bits.endswith(delimiter):
-                message_bits = message_bits[:-len(delimiter)]  # remove delimiter
+        delimiter = io.delimiter_to_binary(delimiter_message)
+        max_values = n_units
+        if max_read is not None:
+            max_values = min(max_values, math.ceil(max_read / unit_bits))
+
+        #read windows of doubling size, so that the cost is linear in the message length
+        window = max(DELIMITER_WINDOW, 2 * len(delimiter))
+        values_read = 0
+        searched = 0
+        while True:
+            stop = min(values_read + math.ceil(window / unit_bits), max_values)
+            message_bits += read(values_read, stop)
+            values_read = stop
+            position = message_bits.find(delimiter, max(0, searched - len(delimiter) + 1))
+            if position >= 0:
+                message_bits = message_bits[:position]  # remove delimiter
+                break
+            if values_read >= max_values:
+                warnings.warn('Delimiter not found.')
                 break
+            searched = len(message_bits)
+            window *= 2
     else:
         raise ValueError(f"Invalid method: {method}")
 
@@ -221,3 +289,332 @@ def extract(array, matching=False, seed=None, bits=1, method='metadata', n_bits=
         message_bits = compression.binary_decompress(message_bits, compress)
 
     return message_bits
+
+
+
+def _extract_into(file, read, n_units, unit_bits, method, n_bits, metadata_length, unit_length):
+    """
+    Extracts the message into a file-like object, CHUNK_SIZE values at a time.
+
+    :param read: Function reading the bits of units start to stop.
+    :param unit_length: Number of values per unit.
+    :return: Number of bits written.
+    :rtype: int
+    """
+    if method == 'metadata':
+        start = math.ceil(metadata_length / unit_bits)
+        metadata_raw = read(0, start)
+        message_length = metadata_raw[:metadata_length].to_int()
+        head = metadata_raw[metadata_length:metadata_length + message_length]
+        stop = math.ceil((metadata_length + message_length) / unit_bits)
+    else:
+        message_length = n_units * unit_bits if n_bits is None else n_bits
+        head = BitBuffer()
+        start = 0
+        stop = math.ceil(message_length / unit_bits)
+
+    sink = io.PayloadSink(file)
+    sink.write(head)
+    window = max(1, CHUNK_SIZE // unit_length)
+    for chunk_start in range(start, min(stop, n_units), window):
+        chunk = read(chunk_start, min(chunk_start + window, stop))
+        sink.write(chunk[:message_length - sink.length])
+    sink.flush()
+    return sink.length
+
+
+def _positions(start, stop, length, seed):
+    """
+    Positions start to stop of the pseudo-random embedding order of an array of given length.
+    """
+    return prng_indices(length, seed, stop - start, start)
+
+
+def _read(content, backend, bits, start, stop, seed=None):
+    """
+    Reads the bits of the values at positions start to stop of the embedding order.
+
+    :param backend: The native backend, or None to use NumPy. Requires a contiguous array.
+    :param seed: Seed of the pseudo-random embedding order, or None for sequential order.
+    :return: BitBuffer
+    """
+    #whole bytes are returned without copying by NumPy
+    if backend is not None and not (seed is None and bits == 8 and content.dtype.itemsize == 1):
+        return _native_extract(backend, content.reshape(-1), bits, start, stop, seed)
+    if seed is not None:
+        positions = _positions(start, stop, content.size, seed)
+    else:
+        positions = slice(start, stop)
+    return _values_to_bits(unsigned_view(_take(content, positions)), bits)
+
+
+def _block_length(matrix):
+    """
+    Number of values per block of matrix embedding with parameter p.
+    """
+    if not 1 <= matrix <= 16:
+        raise ValueError('matrix must be between 1 and 16.')
+    return (1 << matrix) - 1
+
+
+def _syndromes(blocks):
+    """
+    Syndromes of the Hamming code for blocks of LSBs.
+    Column i of the parity check matrix is the binary representation of i+1, so the syndrome
+    is the XOR of the (1-based) positions of all set LSBs in the block.
+
+    :param blocks: LSBs, one block per row.
+    :type blocks: np.ndarray
+    :return: np.ndarray of uint16
+    """
+    columns = np.arange(1, blocks.shape[1] + 1, dtype=np.uint16)
+    return np.bitwise_xor.reduce(blocks * columns, axis=1)
+
+
+def _matrix_encode(lsbs, payload, matrix):
+    """
+    Matrix embedding: changes at most one LSB per block, so that the syndrome of each block
+    equals the next `matrix` bits of the payload. The last group of payload bits is zero-padded.
+
+    :param lsbs: The current LSBs of the used values, a multiple of 2^matrix-1.
+    :type lsbs: BitBuffer
+    :param payload: The payload.
+    :type payload: BitBuffer
+    :param matrix: Parameter p of the Hamming code.
+    :type matrix: int
+    :return: The LSBs the used values must have.
+    :rtype: BitBuffer
+    """
+    blocks = lsbs.unpack().reshape(-1, _block_length(matrix))
+    message = _bits_to_values(payload, matrix, np.uint16)[:len(blocks)]
+    #the position whose column equals the difference of syndrome and message is flipped
+    change = _syndromes(blocks) ^ message
+    rows = np.flatnonzero(change)
+    blocks[rows, change[rows].astype(np.intp) - 1] ^= 1
+    return BitBuffer.from_bits(blocks)
+
+
+def _matrix_decode(lsbs, matrix):
+    """
+    Reads `matrix` bits from the syndrome of each block of LSBs.
+
+    :param lsbs: LSBs of the used values, a multiple of 2^matrix-1.
+    :type lsbs: BitBuffer
+    :return: BitBuffer
+    """
+    blocks = lsbs.unpack().reshape(-1, _block_length(matrix))
+    return _values_to_bits(_syndromes(blocks), matrix)
+
+
+def _payload_chunk(payload, start, n_bits):
+    """
+    Bits start to start+n_bits of the payload. Streamed payloads have to be read in order.
+
+    :type payload: BitBuffer, io.PayloadStream
+    :rtype: BitBuffer
+    """
+    if isinstance(payload, BitBuffer):
+        return payload[start:start + n_bits]
+    return payload.read(n_bits)
+
+
+def _native_embed(backend, content, payload, bits, seed=None, generator=None):
+    """
+    Embeds the payload into a contiguous array with the native backend, CHUNK_SIZE values at a time.
+
+    :param seed: Seed of the pseudo-random embedding order, or None for sequential order.
+    :param generator: Bit generator for LSB matching, or None for LSB replacement.
+    """
+    n_values = min(len(content), math.ceil(len(payload) / bits))
+    itemsize = content.dtype.itemsize
+    signed = int(np.issubdtype(content.dtype, np.signedinteger))
+    array_pointer = content.ctypes.data
+    for start in range(0, n_values, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, n_values)
+        bit_start = start * bits
+        n_bits = min(len(payload) - bit_start, (stop - start) * bits)
+        chunk = _payload_chunk(payload, bit_start, n_bits)
+        payload_pointer = chunk.data.ctypes.data
+        if seed is not None:
+            chunk_indices = _positions(start, stop, len(content), seed)
+            target, indices_pointer = array_pointer, chunk_indices.ctypes.data
+        else:
+            target, indices_pointer = array_pointer + start * itemsize, None
+        if generator is not None:
+            coins = _random_bits(generator, stop - start)
+            backend.embed_matching(target, stop - start, payload_pointer, n_bits,
+                                   bits, itemsize, signed, indices_pointer, coins.data.ctypes.data)
+        else:
+            backend.embed(target, stop - start, payload_pointer, n_bits,
+                          bits, itemsize, indices_pointer)
+
+
+def _native_extract(backend, content, bits, start, stop, seed=None):
+    """
+    Extracts the bits of the values at positions start to stop of a contiguous array
+    with the native backend, CHUNK_SIZE values at a time.
+
+    :param seed: Seed of the pseudo-random embedding order, or None for sequential order.
+    :return: BitBuffer
+    """
+    itemsize = content.dtype.itemsize
+    array_pointer = content.ctypes.data
+    out = np.zeros(math.ceil((stop - start) * bits / 8), dtype=np.uint8)
+    out_pointer = out.ctypes.data
+    for chunk_start in range(start, stop, CHUNK_SIZE):
+        chunk_stop = min(chunk_start + CHUNK_SIZE, stop)
+        out_offset = (chunk_start - start) * bits // 8
+        if seed is not None:
+            chunk_indices = _positions(chunk_start, chunk_stop, len(content), seed)
+            backend.extract(array_pointer, chunk_stop - chunk_start, bits, itemsize,
+                            out_pointer + out_offset, chunk_indices.ctypes.data)
+        else:
+            backend.extract(array_pointer + chunk_start * itemsize, chunk_stop - chunk_start, bits, itemsize,
+                            out_pointer + out_offset, None)
+    return BitBuffer(out, (stop - start) * bits)
+
+
+def _matching_generator(matching):
+    """
+    Bit generator for the random decisions of LSB matching, or None if matching is not used.
+    """
+    #0 is a valid seed, so only None and False disable matching
+    if matching is None or matching is False or matching is np.False_:
+        return None
+    if matching is True or matching is np.True_:
+        return np.random.PCG64()
+    if isinstance(matching, (int, np.integer)):
+        return np.random.PCG64(int(matching))
+    raise TypeError(f'matching must be a bool or an int seed, got {type(matching).__name__}.')
+
+
+def _random_bits(generator, count):
+    """
+    Draws count random bits as a BitBuffer.
+    Whole 64-bit words are drawn, so drawing in chunks of multiples of 64 gives the same bits as one draw.
+    """
+    words = generator.random_raw(-(-count // 64)).astype('<u8')
+    return BitBuffer(words.view(np.uint8), count)
+
+
+def _match(values, payload_array, bits, signed, coins):
+    """
+    LSB matching: the values closest to `values` whose lowest bits are `payload_array`.
+    If two values are equally close, e.g. +1 and -1 for bits=1, the coin decides.
+    Values are kept within the range of their dtype.
+
+    :param values: Unsigned view of the cover values.
+    :type values: np.ndarray
+    :param payload_array: The payload, grouped into values of `bits` bits.
+    :type payload_array: np.ndarray
+    :param signed: Whether the values are a view of a signed dtype.
+    :type signed: bool
+    :param coins: Random bits, one per value.
+    :type coins: BitBuffer
+    :return: np.ndarray
+    """
+    dtype = values.dtype
+    mask = _mask(bits, dtype)
+    width = dtype.itemsize * 8
+    if bits == width:
+        return payload_array.astype(dtype)
+    #flipping the sign bit maps signed values to unsigned order
+    bias = dtype.type(1 << (width - 1) if signed else 0)
+    values = values ^ bias
+    candidate = (values & ~mask) | payload_array
+    step = dtype.type(1 << bits)
+    half = dtype.type(1 << (bits - 1))
+    above = candidate > values
+    distance = np.where(above, candidate - values, values - candidate)
+    move = (distance > half) | ((distance == half) & coins.unpack().astype(bool))
+    #moves to the candidate on the other side of values, if within the dtype range
+    down = move & above & (candidate >= step)
+    up = move & ~above & (candidate <= np.iinfo(dtype).max - step)
+    candidate[down] -= step
+    candidate[up] += step
+    return candidate ^ bias
+
+
+def _take(array, positions):
+    """
+    Values at flat (C-order) positions, without copying non-contiguous arrays.
+    """
+    if array.flags.c_contiguous:
+        return array.reshape(-1)[positions]
+    if isinstance(positions, slice):
+        positions = np.arange(*positions.indices(array.size))
+    return array[np.unravel_index(positions, array.shape)]
+
+
+def _put(array, positions, values):
+    """
+    Writes values at flat (C-order) positions, also into non-contiguous arrays.
+    """
+    if array.flags.c_contiguous:
+        array.reshape(-1)[positions] = values
+        return
+    if isinstance(positions, slice):
+        positions = np.arange(*positions.indices(array.size))
+    array[np.unravel_index(positions, array.shape)] = values
+
+
+def _mask(bits, dtype):
+    """
+    Mask of the lowest bits as a scalar of an unsigned dtype.
+    """
+    width = np.dtype(dtype).itemsize * 8
+    if not 1 <= bits <= width:
+        raise ValueError(f'bits must be between 1 and {width} for dtype {np.dtype(dtype)}.')
+    return np.dtype(f'u{width // 8}').type((1 << bits) - 1)
+
+
+def _bits_to_values(payload, bits, dtype):
+    """
+    Groups the payload into values of `bits` bits each, most significant bit first.
+    The last value is zero-padded.
+
+    :param payload: The payload.
+    :type payload: BitBuffer
+    :param bits: Number of bits per value.
+    :type bits: int
+    :param dtype: Unsigned integer dtype of the values.
+    :return: np.ndarray of dtype
+    """
+    dtype = np.dtype(dtype)
+    _mask(bits, dtype)
+    if bits == 8:
+        return payload.data.astype(dtype)
+    if bits == 1:
+        return payload.unpack().astype(dtype)
+    n_values = -(-len(payload) // bits)
+    payload_bits = np.zeros(n_values * bits, dtype=np.uint8)
+    payload_bits[:len(payload)] = payload.unpack()
+    grouped = payload_bits.reshape(n_values, bits)
+    #loop over bit positions, vectorized over all values
+    values = np.zeros(n_values, dtype=dtype)
+    for b in range(bits):
+        values <<= 1
+        values |= grouped[:, b]
+    return values
+
+
+def _values_to_bits(values, bits):
+    """
+    Concatenates the lowest `bits` bits of each value, most significant bit first.
+
+    :param values: Unsigned integer values.
+    :type values: np.ndarray
+    :param bits: Number of bits per value.
+    :type bits: int
+    :return: BitBuffer
+    """
+    _mask(bits, values.dtype)
+    if bits == 8 and values.dtype == np.uint8:
+        return BitBuffer(values)
+    if bits == 1:
+        return BitBuffer.from_bits(values & 1)
+    grouped = np.empty((len(values), bits), dtype=values.dtype)
+    for b in range(bits):
+        np.right_shift(values, bits - 1 - b, out=grouped[:, b])
+    grouped &= 1
+    return BitBuffer.from_bits(grouped)
@@ -1,11 +1,13 @@
+import functools
 import warnings
-import math
 
 import numpy as np
 
 
 from stegosphere import utils
 from stegosphere import io
+from stegosphere.bitbuffer import BitBuffer
+from stegosphere.tools import compression
 from stegosphere.config import METADATA_LENGTH_VD, DELIMITER_MESSAGE
 
 """
@@ -16,18 +18,27 @@ Pattern recognition letters, 24(9-10), 1613-1626.
 
 """
 
+#Largest number of differences covered by the dense range table
+RANGE_TABLE_LIMIT = 1 << 20
+
+#Number of pairs used first during embedding. Doubles for every further window.
+EMBED_WINDOW = 4096
+
+#Number of pairs decoded first during extraction. Doubles for every further read.
+EXTRACT_WINDOW = 4096
+
 def embed(array, payload, spatial_dim=None, channel_dim=None,
           ranges=None, range_offset=3, range_start=1,
           range_range=None,
           seed=None, method='metadata', metadata_length=METADATA_LENGTH_VD,
-          delimiter_message=DELIMITER_MESSAGE, compress=False):
+          delimiter_message=DELIMITER_MESSAGE, compress=False, out=None):
             
     """
     Embed a payload into a cover array using Value Differencing steganography.
 
 
     :param payload: The payload to be hidden. Gets converted into binary if not already.
-    :type payload: str
+    :type payload: str, bytes, BitBuffer
     :param spatial_dim: Number of spatial dimensions of the data (usually 2 in images, 1 in audio, 3 in video)
     :type spatial_dim: int
     :param channel_dim: Number of channels of the data (3 in RGB, 2 in stereo audio, ...)
@@ -48,11 +59,14 @@ def embed(array, payload, spatial_dim=None, channel_dim=None,
     :type metadata_length: int, optional
     :param delimiter_message: The delimiter string used when `method='delimiter'`.
     :type delimiter_message: str, optional
+    :param out: Array to write the result into, e.g. a np.memmap. Use `out=array` to embed in place.
+                Defaults to a copy of array.
+    :type out: np.ndarray, optional
 
-    :return: True, if it worked.
-    :rtype: bool
+    :return: The array with the embedded payload.
+    :rtype: np.ndarray
     """
-    array = array.copy()
+    array = utils.prepare_out(array, out)
     
     if spatial_dim is None or channel_dim is None:
         if len(array.shape) == 1:
@@ -67,58 +81,53 @@ def embed(array, payload, spatial_dim=None, channel_dim=None,
         ranges = _define_range(range_offset, range_start, range_range)
 
     payload = io.encode_payload(payload, method, metadata_length, delimiter_message, compress)
-    value_pairs = _get_pairs(array, spatial_dim, seed)
-    payload_index = 0
+    payload_bits = payload.unpack()
     max_len = len(payload)
-    
-    for (v1_coords, v2_coords) in value_pairs:
-        if payload_index >= max_len:
-            break
-        for channel in range(channel_dim):
-            v1 = int(array[*v1_coords,channel])
-            v2 = int(array[*v2_coords,channel])
-            d = v2-v1
-            abs_d = abs(d)
-
-            try:
-                bits_to_hide, l_i, u_i = _range(ranges, abs_d)
-            except Exception:
-                continue  # Skip if difference is out of range
-
-            if bits_to_hide>0:
-                #Test boundaries:
-                if d%2!=0:
-                    v1_test = v1 - math.ceil((u_i-d)/2)
-                    v2_test = v2 + math.floor((u_i-d)/2)
-                if d%2==0:
-                    v1_test = v1 - math.floor((u_i-d)/2)
-                    v2_test = v2 + math.ceil((u_i-d)/2)
-
-                #if within boundaries
-                if 0 <= v1_test <= 255 and 0 <= v2_test <= 255:
-                    bits_remaining = max_len - payload_index
-                    bits_to_encode = min(bits_to_hide, bits_remaining)
-                    bin_secret = payload[payload_index:payload_index + bits_to_encode]
-                    if bits_to_encode < bits_to_hide:
-                        bin_secret = bin_secret.ljust(bits_to_hide, '0')
-                        
-                    secret = int(bin_secret,2)
-                    
-                    new_d = l_i+secret if d >= 0 else -(l_i+secret)
-                    
-                    if d%2!=0:
-                        v1_prime = v1 - math.ceil((new_d-d)/2)
-                        v2_prime = v2 + math.floor((new_d-d)/2)
-                    if d%2==0:
-                        v1_prime = v1 - math.floor((new_d-d)/2)
-                        v2_prime = v2 + math.ceil((new_d-d)/2)
-                    payload_index += bits_to_hide
-                    
-                    array[*v1_coords, channel] = v1_prime
-                    array[*v2_coords, channel] = v2_prime
-                else:
-                    
-                    continue  # Skip if pixel values go out of bounds
+    min_value, max_value = _bounds(array.dtype)
+    n_pairs = int(np.prod(array.shape[:spatial_dim])) // 2
+
+    #pairs are processed in windows of doubling size until the payload is consumed,
+    #the changes are written at the end so that the array is unchanged on errors
+    updates = []
+    consumed = 0
+    pairs_done = 0
+    window = EMBED_WINDOW
+    while consumed < max_len and pairs_done < n_pairs:
+        stop = min(pairs_done + window, n_pairs)
+        first, second = _pair_coordinates(_get_pairs(array, spatial_dim, seed, pairs_done, stop), array, spatial_dim)
+        pairs_done = stop
+        window *= 2
+
+        #all (pair, channel) slots of the window at once, in order of the pairs, then channels
+        v1 = _gather(array, first, channel_dim)
+        v2 = _gather(array, second, channel_dim)
+        d = v2 - v1
+        bits_to_hide, l_i, u_i = _lookup(ranges, np.abs(d))
+        usable = (bits_to_hide > 0) & _within_bounds(v1, v2, d, u_i, array.dtype)
+
+        #sequential payload consumption: each slot starts where the previous usable slots end
+        capacity = np.where(usable, bits_to_hide, 0)
+        offsets = consumed + np.cumsum(capacity) - capacity.reshape(-1)
+        #embedding stops at the first pair that starts after the payload, remaining channels of a pair are zero-padded
+        pair_capacity = capacity.sum(axis=1)
+        pair_start = consumed + np.cumsum(pair_capacity) - pair_capacity
+        slots = usable & (pair_start < max_len)[:, None]
+        consumed += int(pair_capacity.sum())
+        if not slots.any():
+            continue
+
+        secret = _read_values(payload_bits, offsets[slots.reshape(-1)], bits_to_hide[slots])
+        new_d = np.where(d[slots] >= 0, l_i[slots] + secret, -(l_i[slots] + secret))
+        v1_prime, v2_prime = _shift(v1[slots], v2[slots], d[slots], new_d)
+        if (np.minimum(v1_prime, v2_prime) < min_value).any() or (np.maximum(v1_prime, v2_prime) > max_value).any():
+            raise OverflowError(f'Embedded values do not fit into {array.dtype}, the ranges do not match the data.')
+
+        pair_idx, channel = np.nonzero(slots)
+        updates.append((tuple(c[pair_idx] for c in first) + (channel,), v1_prime))
+        updates.append((tuple(c[pair_idx] for c in second) + (channel,), v2_prime))
+
+    for index, values in updates:
+        array[index] = values
 
     return array
 
@@ -144,7 +153,7 @@ def extract(array, spatial_dim=None, channel_dim=None,
     :type delimiter_message: str, optional
 
     :return: The decoded message
-    :rtype: str or tuple
+    :rtype: BitBuffer
     """
     assert method in ['metadata','delimiter',None], 'Method must be either delimiter, metadata, or None.'
 
@@ -161,48 +170,46 @@ def extract(array, spatial_dim=None, channel_dim=None,
             range_range = utils.dtype_range(array.dtype)
         ranges = _define_range(range_offset, range_start, range_range)
 
-        
-    bin_payload = ""
-    value_pairs = _get_pairs(array, spatial_dim, seed)
-    for (v1_coords, v2_coords) in value_pairs:
-        for channel in range(channel_dim):
-            v1 = int(array[*v1_coords,channel])
-            v2 = int(array[*v2_coords,channel])
-            d = v2 - v1
-            abs_d = abs(d)
-
-            try:
-                bits_retrieved, l_i, u_i = _range(ranges, abs_d)
-            except Exception:
-                continue  # Skip if difference is out of range
-            if bits_retrieved > 0:
-                #Test boundaries
-                if d%2!=0:
-                    v1_prime = v1 - math.ceil((u_i-d)/2)
-                    v2_prime = v2 + math.floor((u_i-d)/2)
-                if d%2==0:
-                    v1_prime = v1 - math.floor((u_i-d)/2)
-                    v2_prime = v2 + math.ceil((u_i-d)/2)
-
-                if 0 <= v1_prime <= 255 and 0 <= v2_prime <= 255:
-                    s = abs_d - l_i
-                    bits = bin(s)[2:].zfill(bits_retrieved)
-                    bin_payload += bits
-                else: 
-                    continue  # Skip if pixel values go out of bounds
-    
+
+    n_pairs = int(np.prod(array.shape[:spatial_dim])) // 2
+    bin_payload = BitBuffer()
+    pairs_read = 0
+    window = EXTRACT_WINDOW
+
+    def read_bits(needed=None):
+        #decodes further pairs, in windows of doubling size, until `needed` bits are available
+        nonlocal bin_payload, pairs_read, window
+        chunks = [bin_payload]
+        n_read = len(bin_payload)
+        while pairs_read < n_pairs and (needed is None or n_read < needed):
+            stop = n_pairs if needed is None else min(pairs_read + window, n_pairs)
+            pairs = _get_pairs(array, spatial_dim, seed, pairs_read, stop)
+            chunks.append(_decode(array, pairs, spatial_dim, channel_dim, ranges))
+            n_read += len(chunks[-1])
+            pairs_read = stop
+            window *= 2
+        if len(chunks) > 1:
+            bin_payload = BitBuffer.from_bits(np.concatenate([chunk.unpack() for chunk in chunks]))
+        return bin_payload
+
     if method == 'metadata':
-        length = int(bin_payload[:metadata_length], 2)
+        #only the pairs holding the metadata and the declared message are decoded
+        length = read_bits(metadata_length)[:metadata_length].to_int()
         payload_end = metadata_length + length
-        payload = bin_payload[metadata_length:payload_end]
+        payload = read_bits(payload_end)[metadata_length:payload_end]
     elif method == 'delimiter':
-        if not is_binary(delimiter_message):
-            delimiter_message = data_to_binary(delimiter_message)
-        payload = bin_payload.split(delimiter_message)[0]
+        delimiter = io.delimiter_to_binary(delimiter_message)
+        searched = 0
+        while True:
+            payload_end = read_bits(searched + 1).find(delimiter, max(0, searched - len(delimiter) + 1))
+            if payload_end >= 0 or pairs_read >= n_pairs:
+                break
+            searched = len(bin_payload)
+        payload = bin_payload[:payload_end] if payload_end >= 0 else bin_payload
     elif method is None:
         if n_bits is None: 
-            return bin_payload
-        return bin_payload[:n_bits]
+            return read_bits()
+        return read_bits(n_bits)[:n_bits]
 
     if compress:
         payload = compression.binary_decompress(payload, compress)
@@ -228,16 +235,184 @@ def _define_range(range_offset, range_start, range_range):
 
 def _range(ranges, diff):
     """Return the number of bits to embed and the lower and upper bounds based on the pixel difference."""
-    #faster then dictionary access
-    for i, l_i, u_i in ranges:
-        if l_i<=diff<=u_i:
-            return i, l_i, u_i
-        
-def _get_pairs(array, spatial_dim, seed=None):
-    #position pairs
-    indices = np.ndindex(*array.shape[:spatial_dim])
-    indices = list(indices)
+    table = _range_table(ranges)
+    if diff < len(table):
+        bits, l_i, u_i = table[diff].tolist()
+    else:
+        bits, l_i, u_i = (int(v[0]) for v in _lookup(ranges, np.array([diff])))
+    if bits < 0:
+        return None
+    return bits, l_i, u_i
+
+
+def _range_table(ranges):
+    """
+    Dense lookup table of shape (n, 3) with (bits, lower, upper) of the range of each difference |d| < n.
+    Differences without a range have -1 bits. Covers all ranges up to RANGE_TABLE_LIMIT differences.
+    """
+    return _cached_range_table(_int64_ranges(ranges))
+
+
+def _int64_ranges(ranges):
+    """
+    The ranges as tuples of ints, limited to the differences of int64 values used for computation.
+    Upper bounds are clipped to the int64 maximum, ranges starting beyond it can never match and are dropped.
+    """
+    limit = np.iinfo(np.int64).max
+    return tuple((int(i), int(l_i), min(int(u_i), limit)) for i, l_i, u_i in ranges if l_i <= limit)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_range_table(ranges):
+    size = min(max((u_i for _, _, u_i in ranges), default=-1) + 1, RANGE_TABLE_LIMIT)
+    table = np.zeros((max(size, 0), 3), dtype=np.int64)
+    table[:, 0] = -1
+    #the first matching range wins, so ranges are applied in reverse order
+    for i, l_i, u_i in reversed(ranges):
+        table[max(l_i, 0):u_i + 1] = (i, l_i, u_i)
+    table.flags.writeable = False
+    return table
+
+
+def _lookup(ranges, abs_d):
+    """
+    Vectorized _range. Returns arrays of bits, lower and upper bounds for each difference.
+    Differences without a range get -1 bits.
+    """
+    table = _range_table(ranges)
+    if len(table) and abs_d.size and abs_d.max() < len(table):
+        result = table[abs_d]
+    else:
+        #differences beyond the table are matched against the ranges
+        result = np.zeros(abs_d.shape + (3,), dtype=np.int64)
+        result[..., 0] = -1
+        for i, l_i, u_i in reversed(_int64_ranges(ranges)):
+            result[(l_i <= abs_d) & (abs_d <= u_i)] = (i, l_i, u_i)
+    return result[..., 0], result[..., 1], result[..., 2]
+
+
+def _shift(v1, v2, d, new_d):
+    """
+    Changes the difference of the pairs (v1, v2) from d to new_d, splitting the change between both values.
+    The larger part goes to v1 if d is odd, to v2 if d is even.
+    """
+    change = new_d - d
+    odd = d % 2 != 0
+    #v1 - ceil(change/2), v2 + floor(change/2) if odd; v1 - floor(change/2), v2 + ceil(change/2) if even
+    v1_prime = np.where(odd, v1 + (-change) // 2, v1 - change // 2)
+    v2_prime = np.where(odd, v2 + change // 2, v2 - (-change) // 2)
+    return v1_prime, v2_prime
+
+
+def _within_bounds(v1, v2, d, u_i, dtype):
+    """
+    Whether both values of the pairs stay within the range of the dtype if the difference is set to u_i.
+    """
+    min_value, max_value = _bounds(dtype)
+    v1_test, v2_test = _shift(v1, v2, d, u_i)
+    return (min_value <= v1_test) & (v1_test <= max_value) & (min_value <= v2_test) & (v2_test <= max_value)
+
+
+def _bounds(dtype):
+    """
+    Minimum and maximum value of the dtype, limited to the int64 values used for computation.
+    """
+    min_value, max_value = utils.dtype_range(dtype)
+    int64 = np.iinfo(np.int64)
+    return max(int(min_value), int64.min), min(int(max_value), int64.max)
+
+
+def _decode(array, pairs, spatial_dim, channel_dim, ranges):
+    """
+    Reads the bits hidden in the given pairs, in order of the pairs, then channels.
+
+    :return: BitBuffer
+    """
+    first, second = _pair_coordinates(pairs, array, spatial_dim)
+    v1 = _gather(array, first, channel_dim)
+    v2 = _gather(array, second, channel_dim)
+    d = v2 - v1
+    abs_d = np.abs(d)
+    bits_retrieved, l_i, u_i = _lookup(ranges, abs_d)
+    slots = (bits_retrieved > 0) & _within_bounds(v1, v2, d, u_i, array.dtype)
+
+    s = abs_d[slots] - l_i[slots]
+    #differences beyond the embeddable part of a range are read with all their bits
+    width = bits_retrieved[slots]
+    overflow = (s >> width) > 0
+    while overflow.any():
+        width = width + overflow
+        overflow = (s >> width) > 0
+    return _write_values(s, width)
+
+
+def _gather(array, coordinates, channel_dim):
+    """
+    Values at the given spatial coordinates for each channel, as int64 array (n, channel_dim).
+    """
+    values = np.empty((len(coordinates[0]), channel_dim), dtype=np.int64)
+    for channel in range(channel_dim):
+        values[:, channel] = array[coordinates + (channel,)]
+    return values
+
+
+def _read_values(bits, offsets, widths):
+    """
+    Reads the unsigned integers of given widths starting at the given offsets of a bit array.
+    Bits past the end of the array are zero.
+    """
+    values = np.zeros(len(offsets), dtype=np.int64)
+    if not offsets.size:
+        return values
+    max_width = int(widths.max())
+    #only the bits between the first and last offset are copied
+    first = int(offsets.min())
+    end = int(offsets.max()) + max_width
+    window = np.zeros(end - first, dtype=np.uint8)
+    available = bits[first:end]
+    window[:len(available)] = available
+    relative = offsets - first
+    for j in range(max_width):
+        active = j < widths
+        values[active] = (values[active] << 1) | window[relative[active] + j]
+    return values
+
+
+def _write_values(values, widths):
+    """
+    Concatenates the binary representations of the values with the given widths.
+
+    :return: BitBuffer
+    """
+    ends = np.cumsum(widths)
+    bits = np.zeros(int(ends[-1]) if ends.size else 0, dtype=np.uint8)
+    starts = ends - widths
+    for j in range(int(widths.max()) if widths.size else 0):
+        active = np.flatnonzero(j < widths)
+        bits[starts[active] + j] = (values[active] >> (widths[active] - 1 - j)) & 1
+    return BitBuffer.from_bits(bits)
+
+
+def _get_pairs(array, spatial_dim, seed=None, start=0, stop=None):
+    """
+    Position pairs as two arrays of flat indices into the spatial dimensions, first and second value of each pair.
+    Consecutive positions (in C order, or in the pseudo-random order if a seed is given) form a pair.
+    Only pairs start to stop are generated.
+    """
+    n_positions = int(np.prod(array.shape[:spatial_dim]))
+    n_pairs = n_positions // 2
+    stop = n_pairs if stop is None else min(stop, n_pairs)
+    start = min(start, stop)
     if seed is not None:
-        np.random.default_rng(seed).shuffle(indices)
-    pairs = [(indices[i], indices[i+1]) for i in range(0, len(indices)-1,2)]
-    return pairs
+        order = utils.prng_indices(n_positions, seed, 2 * (stop - start), 2 * start)
+    else:
+        order = np.arange(2 * start, 2 * stop)
+    return order[0::2], order[1::2]
+
+
+def _pair_coordinates(pairs, array, spatial_dim):
+    """
+    Coordinates of the first and second values of the pairs, as tuples of index arrays.
+    """
+    shape = array.shape[:spatial_dim]
+    return tuple(np.unravel_index(positions, shape) for positions in pairs)
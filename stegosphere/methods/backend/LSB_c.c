@@ -1,87 +1,312 @@
-#include <stdio.h>
-#include <stdlib.h>
-#include <string.h>
 #include <stdint.h>
+#include <string.h>
+
+/*
+ * Native backend for stegosphere.methods.LSB, loaded with ctypes.
+ * ctypes releases the GIL while these functions run, so several threads can embed/extract in parallel.
+ *
+ * Payloads are packed bits, most significant bit first (as produced by np.packbits).
+ * Elements are treated as unsigned integers of element_size bytes. For LSB matching, signed elements are
+ * mapped to unsigned order by flipping their sign bit (sign_bias).
+ * Sizes, bit counts and indices are 64-bit, so arrays with more than 2^31 elements are supported.
+ */
+
+#if defined(_WIN32) || defined(__CYGWIN__)
+#define LSB_EXPORT __declspec(dllexport)
+#else
+#define LSB_EXPORT __attribute__((visibility("default")))
+#endif
+
+/* forced inlining, so that kernels called with constant params are specialised */
+#if defined(_MSC_VER)
+#define LSB_INLINE __forceinline
+#else
+#define LSB_INLINE inline __attribute__((always_inline))
+#endif
+
+/*
+ * Version of the function signatures below. Checked by the loader so that stale builds are not used.
+ */
+LSB_EXPORT
+int abi_version(void) {
+    return 4;
+}
+
+static inline uint64_t low_mask(int param) {
+    return (param >= 64) ? ~0ULL : (((uint64_t)1 << param) - 1ULL);
+}
+
+/*
+ * Reads the payload 'param' bits at a time. For param <= 56 the bits are taken from a 64-bit accumulator,
+ * wider params are read bit by bit. Bits past n_bits are zero.
+ */
+typedef struct {
+    const uint8_t* payload;
+    int64_t n_bits;
+    int64_t n_bytes;
+    int64_t byte_pos;
+    int64_t bit_pos;
+    uint64_t acc;
+    int acc_bits;
+} payload_reader;
+
+static inline payload_reader reader_init(const uint8_t* payload, int64_t n_bits) {
+    payload_reader reader = {payload, n_bits, (n_bits + 7) / 8, 0, 0, 0, 0};
+    return reader;
+}
+
+static inline uint64_t reader_next(payload_reader* reader, int param, uint64_t mask) {
+    uint64_t bits = 0;
+    if(param <= 56) {
+        while(reader->acc_bits < param) {
+            reader->acc = (reader->acc << 8) |
+                          (reader->byte_pos < reader->n_bytes ? reader->payload[reader->byte_pos] : 0U);
+            reader->byte_pos++;
+            reader->acc_bits += 8;
+        }
+        reader->acc_bits -= param;
+        return (reader->acc >> reader->acc_bits) & mask;
+    }
+    for(int b = 0; b < param; b++) {
+        int64_t pos = reader->bit_pos++;
+        uint64_t bit_val = (pos < reader->n_bits) ? ((reader->payload[pos >> 3] >> (7 - (pos & 7))) & 1U) : 0;
+        bits = (bits << 1) | bit_val;
+    }
+    return bits;
+}
+
+/*
+ * LSB matching of a single value, in unsigned order: returns the value closest to 'value' whose lowest bits
+ * are 'bits'. Of two equally close values, 'coin' selects the one on the other side of value.
+ * Values that would leave [0, max_value] fall back to the in-range candidate.
+ * For bits == 1 this is the classic +-1 embedding.
+ */
+static inline uint64_t match_value(uint64_t value, uint64_t bits, uint64_t mask, uint64_t max_value,
+                                   uint64_t step, uint64_t half, int coin) {
+    /* branch-free, the decisions are random and would defeat branch prediction */
+    uint64_t candidate = (value & ~mask) | bits;
+    uint64_t above = candidate > value;
+    uint64_t distance = above ? candidate - value : value - candidate;
+    uint64_t move = (distance > half) | ((distance == half) & (uint64_t)coin);
+    uint64_t down = move & above & (candidate >= step);
+    uint64_t up = move & (above ^ 1U) & (candidate <= max_value - step);
+    return candidate - down * step + up * step;
+}
+
+/*
+ * Typed kernels. The packed kernels handle sequential embedding/extraction where param divides 8, one payload
+ * byte at a time; they are called with constant params so that the compiler can unroll and vectorise them.
+ */
+#define DEFINE_KERNELS(T, SUFFIX)                                                         \
+static LSB_INLINE void embed_packed_##SUFFIX(T* arr, int64_t n_bytes, const uint8_t* payload, \
+                                         const int param) {                               \
+    const int per_byte = 8 / param;                                                       \
+    const T keep = (T)~(T)low_mask(param);                                                \
+    const unsigned mask = (unsigned)low_mask(param);                                      \
+    for(int64_t i = 0; i < n_bytes; i++) {                                                \
+        unsigned byte = payload[i];                                                       \
+        T* values = arr + i * per_byte;                                                   \
+        for(int k = 0; k < per_byte; k++) {                                               \
+            values[k] = (T)((values[k] & keep) | ((byte >> (8 - param * (k + 1))) & mask)); \
+        }                                                                                 \
+    }                                                                                     \
+}                                                                                         \
+                                                                                          \
+static LSB_INLINE void extract_packed_##SUFFIX(const T* arr, int64_t n_bytes, uint8_t* out,   \
+                                           const int param) {                             \
+    const int per_byte = 8 / param;                                                       \
+    const unsigned mask = (unsigned)low_mask(param);                                      \
+    for(int64_t i = 0; i < n_bytes; i++) {                                                \
+        const T* values = arr + i * per_byte;                                             \
+        unsigned byte = 0;                                                                \
+        for(int k = 0; k < per_byte; k++) {                                               \
+            byte = (byte << param) | ((unsigned)values[k] & mask);                        \
+        }                                                                                 \
+        out[i] = (uint8_t)byte;                                                           \
+    }                                                                                     \
+}                                                                                         \
+                                                                                          \
+static int64_t packed_bytes_##SUFFIX(int64_t count, int param) {                          \
+    /* number of whole payload bytes the packed kernels can handle */                     \
+    if(param != 1 && param != 2 && param != 4 && param != 8) {                            \
+        return 0;                                                                         \
+    }                                                                                     \
+    return count / (8 / param);                                                           \
+}                                                                                         \
+                                                                                          \
+static void embed_##SUFFIX(T* arr, int64_t count, const uint8_t* payload, int64_t n_bits, \
+                           int param, const int64_t* indices) {                          \
+    uint64_t mask = low_mask(param);                                                      \
+    if(!indices) {                                                                        \
+        int64_t n_bytes = packed_bytes_##SUFFIX(count, param);                            \
+        switch(param) {                                                                   \
+            case 1: embed_packed_##SUFFIX(arr, n_bytes, payload, 1); break;               \
+            case 2: embed_packed_##SUFFIX(arr, n_bytes, payload, 2); break;               \
+            case 4: embed_packed_##SUFFIX(arr, n_bytes, payload, 4); break;               \
+            case 8:                                                                       \
+                if(sizeof(T) == 1) memcpy(arr, payload, (size_t)n_bytes);                 \
+                else embed_packed_##SUFFIX(arr, n_bytes, payload, 8);                     \
+                break;                                                                    \
+            default: break;                                                               \
+        }                                                                                 \
+        /* the remaining values continue at the next payload byte */                      \
+        int64_t done = n_bytes * 8 / param;                                               \
+        arr += done;                                                                      \
+        count -= done;                                                                    \
+        payload += n_bytes;                                                               \
+        n_bits -= n_bytes * 8;                                                            \
+    }                                                                                     \
+    payload_reader reader = reader_init(payload, n_bits);                                 \
+    for(int64_t i = 0; i < count; i++) {                                                  \
+        int64_t index = indices ? indices[i] : i;                                         \
+        uint64_t bits = reader_next(&reader, param, mask);                                \
+        arr[index] = (T)((arr[index] & ~mask) | bits);                                    \
+    }                                                                                     \
+}                                                                                         \
+                                                                                          \
+static void embed_matching_##SUFFIX(T* arr, int64_t count, const uint8_t* payload,       \
+                                    int64_t n_bits, int param, uint64_t sign_bias,        \
+                                    const int64_t* indices, const uint8_t* random) {      \
+    uint64_t mask = low_mask(param);                                                      \
+    uint64_t max_value = (uint64_t)(T)~(T)0;                                              \
+    /* no alternative candidates if all bits of the value are replaced */                 \
+    uint64_t step = (param >= 8 * (int)sizeof(T)) ? 0 : ((uint64_t)1 << param);          \
+    if(step == 0) {                                                                       \
+        /* all bits are replaced, including the sign bit, so matching equals replacement */ \
+        embed_##SUFFIX(arr, count, payload, n_bits, param, indices);                      \
+        return;                                                                           \
+    }                                                                                     \
+    uint64_t half = (uint64_t)1 << (param - 1);                                           \
+    payload_reader reader = reader_init(payload, n_bits);                                 \
+    for(int64_t i = 0; i < count; i++) {                                                  \
+        int64_t index = indices ? indices[i] : i;                                         \
+        uint64_t bits = reader_next(&reader, param, mask);                                \
+        int coin = (random[i >> 3] >> (7 - (i & 7))) & 1;                                 \
+        uint64_t value = (uint64_t)arr[index] ^ sign_bias;                                \
+        arr[index] = (T)(match_value(value, bits, mask, max_value, step, half, coin) ^ sign_bias); \
+    }                                                                                     \
+}                                                                                         \
+                                                                                          \
+static void extract_##SUFFIX(const T* arr, int64_t length, int param,                    \
+                             uint8_t* out, const int64_t* indices) {                     \
+    uint64_t mask = low_mask(param);                                                      \
+    if(!indices) {                                                                        \
+        int64_t n_bytes = packed_bytes_##SUFFIX(length, param);                           \
+        switch(param) {                                                                   \
+            case 1: extract_packed_##SUFFIX(arr, n_bytes, out, 1); break;                 \
+            case 2: extract_packed_##SUFFIX(arr, n_bytes, out, 2); break;                 \
+            case 4: extract_packed_##SUFFIX(arr, n_bytes, out, 4); break;                 \
+            case 8:                                                                       \
+                if(sizeof(T) == 1) memcpy(out, arr, (size_t)n_bytes);                     \
+                else extract_packed_##SUFFIX(arr, n_bytes, out, 8);                       \
+                break;                                                                    \
+            default: break;                                                               \
+        }                                                                                 \
+        int64_t done = n_bytes * 8 / param;                                               \
+        arr += done;                                                                      \
+        length -= done;                                                                   \
+        out += n_bytes;                                                                   \
+    }                                                                                     \
+    uint64_t acc = 0;                                                                     \
+    int acc_bits = 0;                                                                     \
+    int64_t out_pos = 0;                                                                  \
+    for(int64_t i = 0; i < length; i++) {                                                 \
+        int64_t index = indices ? indices[i] : i;                                         \
+        uint64_t stored_bits = (uint64_t)arr[index] & mask;                               \
+        if(param <= 56) {                                                                 \
+            acc = (acc << param) | stored_bits;                                           \
+            acc_bits += param;                                                            \
+            while(acc_bits >= 8) {                                                        \
+                acc_bits -= 8;                                                            \
+                out[out_pos++] = (uint8_t)(acc >> acc_bits);                              \
+            }                                                                             \
+        } else {                                                                          \
+            for(int b = 0; b < param; b++) {                                              \
+                int64_t pos = i * param + b;                                              \
+                if((stored_bits >> (param - 1 - b)) & 1ULL) {                             \
+                    out[pos >> 3] |= (uint8_t)(0x80U >> (pos & 7));                       \
+                }                                                                         \
+            }                                                                             \
+        }                                                                                 \
+    }                                                                                     \
+    if(acc_bits > 0) {                                                                    \
+        out[out_pos] = (uint8_t)(acc << (8 - acc_bits));                                  \
+    }                                                                                     \
+}
+
+DEFINE_KERNELS(uint8_t, u8)
+DEFINE_KERNELS(uint16_t, u16)
+DEFINE_KERNELS(uint32_t, u32)
+DEFINE_KERNELS(uint64_t, u64)
 
 /*
  * embed:
  *   arr          - pointer to the array of integer elements (any size: 8,16,32,64 bits)
  *   length       - number of elements in the array
- *   bitstring    - binary string to embed (e.g., "101010..."), up to param*length bits
+ *   payload      - packed bits to embed, padding bits of the last byte must be zero
+ *   n_bits       - number of valid bits in payload
  *   param        - number of overwritten LSBs in each element
  *   element_size - size of each element in bytes (1, 2, 4, or 8)
  *   indices      - if non-NULL, an array of indices that specifies the order in which to embed bits.
  *
- * Overwrites 'param' LSBs of each selected element in arr with bits from bitstring.
- * If bitstring is shorter than param*length, not all elements will be updated.
- * If bitstring is longer, extra bits are ignored.
+ * Overwrites 'param' LSBs of each selected element in arr with bits from payload.
+ * The last element is zero-padded if n_bits is not a multiple of param.
+ * If payload is longer than param*length bits, extra bits are ignored.
  */
-__declspec(dllexport)
+LSB_EXPORT
 void embed(
     void* arr,
-    int length,
-    const char* bitstring,
+    int64_t length,
+    const uint8_t* payload,
+    int64_t n_bits,
     int param,
     int element_size,
-    const int* indices  // new parameter for random indices
+    const int64_t* indices
 ) {
-    int bitstring_len = (int)strlen(bitstring);           // total bits in bitstring
-    int max_elements_for_bits = bitstring_len / param;      // how many elements can store bits fully
-    int embed_count = (length < max_elements_for_bits) ? length : max_elements_for_bits;
-    
-    // For each element that will store bits:
-    for(int i = 0; i < embed_count; i++) {
-        int index = indices ? indices[i] : i;  // use random index if provided
-        // Address of the element to modify
-        char* elem_ptr = (char*)arr + index * element_size;
-        
-        // Gather param bits from the bitstring into a temporary variable 'bits'
-        uint64_t bits = 0;
-        for(int b = 0; b < param; b++) {
-            int idx = i * param + b;  // index in the bitstring
-            char c = bitstring[idx];  // '0' or '1'
-            int bit_val = (c == '1') ? 1 : 0;
-            bits = (bits << 1) | bit_val;
-        }
-        
-        // Overwrite the param LSBs using masking based on the element size
-        switch(element_size) {
-            case 1: {
-                uint8_t val = *((uint8_t*)elem_ptr);
-                uint8_t mask = (1U << param) - 1U;
-                val &= ~mask;
-                val |= (uint8_t)(bits & mask);
-                *((uint8_t*)elem_ptr) = val;
-                break;
-            }
-            case 2: {
-                uint16_t val = *((uint16_t*)elem_ptr);
-                uint16_t mask = (1U << param) - 1U;
-                val &= ~mask;
-                val |= (uint16_t)(bits & mask);
-                *((uint16_t*)elem_ptr) = val;
-                break;
-            }
-            case 4: {
-                uint32_t val = *((uint32_t*)elem_ptr);
-                uint32_t mask = (1U << param) - 1U;
-                val &= ~mask;
-                val |= (uint32_t)(bits & mask);
-                *((uint32_t*)elem_ptr) = val;
-                break;
-            }
-            case 8: {
-                uint64_t val = *((uint64_t*)elem_ptr);
-                uint64_t mask = ((uint64_t)1 << param) - 1ULL;
-                val &= ~mask;
-                val |= (bits & mask);
-                *((uint64_t*)elem_ptr) = val;
-                break;
-            }
-            default:
-                // Unsupported size
-                break;
-        }
+    int64_t needed_elements = (n_bits + param - 1) / param;
+    int64_t embed_count = (length < needed_elements) ? length : needed_elements;
+
+    switch(element_size) {
+        case 1: embed_u8((uint8_t*)arr, embed_count, payload, n_bits, param, indices); break;
+        case 2: embed_u16((uint16_t*)arr, embed_count, payload, n_bits, param, indices); break;
+        case 4: embed_u32((uint32_t*)arr, embed_count, payload, n_bits, param, indices); break;
+        case 8: embed_u64((uint64_t*)arr, embed_count, payload, n_bits, param, indices); break;
+        default: break;
+    }
+}
+
+/*
+ * embed_matching:
+ *   arr, length, payload, n_bits, param, element_size, indices - as for embed
+ *   is_signed    - whether the elements are signed integers
+ *   random       - packed random bits, at least one per embedded element
+ *
+ * Like embed, but instead of overwriting the LSBs, every selected element is changed to the closest value
+ * holding the payload bits (LSB matching). Ties are broken by the i-th random bit for the i-th element.
+ * The dtype range is never left.
+ */
+LSB_EXPORT
+void embed_matching(
+    void* arr,
+    int64_t length,
+    const uint8_t* payload,
+    int64_t n_bits,
+    int param,
+    int element_size,
+    int is_signed,
+    const int64_t* indices,
+    const uint8_t* random
+) {
+    int64_t needed_elements = (n_bits + param - 1) / param;
+    int64_t embed_count = (length < needed_elements) ? length : needed_elements;
+    uint64_t sign_bias = is_signed ? ((uint64_t)1 << (8 * element_size - 1)) : 0;
+
+    switch(element_size) {
+        case 1: embed_matching_u8((uint8_t*)arr, embed_count, payload, n_bits, param, sign_bias, indices, random); break;
+        case 2: embed_matching_u16((uint16_t*)arr, embed_count, payload, n_bits, param, sign_bias, indices, random); break;
+        case 4: embed_matching_u32((uint32_t*)arr, embed_count, payload, n_bits, param, sign_bias, indices, random); break;
+        case 8: embed_matching_u64((uint64_t*)arr, embed_count, payload, n_bits, param, sign_bias, indices, random); break;
+        default: break;
     }
 }
 
@@ -91,50 +316,25 @@ void embed(
  *   length       - number of elements to extract bits from
  *   param        - how many LSBs to read from each element
  *   element_size - size of each element in bytes
- *   out_str      - buffer to store extracted bits (as '0'/'1' chars)
+ *   out          - zero-initialised buffer of at least ceil(param*length/8) bytes for the packed bits
  *   indices      - if non-NULL, an array of indices that specifies the order in which to extract bits.
  *
- * Reads 'param' bits from each selected element and reconstructs them into out_str.
- * out_str should be at least param*length + 1 in size to store the bits plus the null terminator.
+ * Reads 'param' bits from each selected element and packs them into out.
  */
-__declspec(dllexport)
+LSB_EXPORT
 void extract(
     const void* arr,
-    int length,
+    int64_t length,
     int param,
     int element_size,
-    char* out_str,
-    const int* indices  // new parameter for random indices
+    uint8_t* out,
+    const int64_t* indices
 ) {
-    int total_bits = param * length;  // total bits we will extract
-    
-    for(int i = 0; i < length; i++) {
-        int index = indices ? indices[i] : i;  // use provided random index if available
-        // Address of the element to read
-        const char* elem_ptr = (const char*)arr + index * element_size;
-        
-        uint64_t val = 0;
-        switch(element_size) {
-            case 1: val = *((const uint8_t*)elem_ptr); break;
-            case 2: val = *((const uint16_t*)elem_ptr); break;
-            case 4: val = *((const uint32_t*)elem_ptr); break;
-            case 8: val = *((const uint64_t*)elem_ptr); break;
-            default: break;
-        }
-        
-        // Extract param bits from val
-        uint64_t mask = ((uint64_t)1 << param) - 1ULL;
-        uint64_t stored_bits = val & mask;
-        
-        // Write the bits as characters ('0' or '1') into out_str
-        for(int b = 0; b < param; b++) {
-            int out_idx = i * param + b;
-            if(out_idx >= total_bits) break;
-            int shift = param - 1 - b;
-            int bit_val = (int)((stored_bits >> shift) & 1ULL);
-            out_str[out_idx] = bit_val ? '1' : '0';
-        }
+    switch(element_size) {
+        case 1: extract_u8((const uint8_t*)arr, length, param, out, indices); break;
+        case 2: extract_u16((const uint16_t*)arr, length, param, out, indices); break;
+        case 4: extract_u32((const uint32_t*)arr, length, param, out, indices); break;
+        case 8: extract_u64((const uint64_t*)arr, length, param, out, indices); break;
+        default: break;
     }
-    
-    out_str[total_bits] = '\0';  // null-terminate the string
 }
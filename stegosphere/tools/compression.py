@@ -1,20 +1,18 @@
 import lzma
 import zlib
 
+from stegosphere.bitbuffer import BitBuffer, as_bits
+
 __all__ = ['compress', 'decompress', 'binary_compress', 'binary_decompress']
 
 
-def bits_to_bytes(binary_string):
-    pad_len = (8 - len(binary_string) % 8) % 8
-    binary_string += '0' * pad_len
-    byte_array = bytearray()
-    for i in range(0, len(binary_string), 8):
-        byte = binary_string[i:i+8]
-        byte_array.append(int(byte, 2))
-    return bytes(byte_array), pad_len
+def bits_to_bytes(binary):
+    binary = as_bits(binary)
+    pad_len = (8 - len(binary) % 8) % 8
+    return binary.tobytes(), pad_len
 
 def bytes_to_bits(byte_data, pad_len):
-    bits = ''.join(f'{byte:08b}' for byte in byte_data)
+    bits = BitBuffer.from_bytes(byte_data)
     if pad_len > 0:
         bits = bits[:-pad_len]
     return bits
@@ -53,33 +51,34 @@ def decompress(byte, method='lzma'):
     elif method=='deflate':
         return zlib.decompress(byte)
     
-def binary_compress(binary_string, method='lzma'):
+def binary_compress(binary, method='lzma'):
     """
-    Compresses a binary string using lzma and returns the compressed binary string.
+    Compresses binary data using lzma and returns the compressed binary data.
     The padding length is stored in the first 8 bits.
+
+    :param binary: The binary data.
+    :type binary: BitBuffer, str
+    :rtype: BitBuffer
     """
     if method == 'lzma':
-        byte_data, pad_len = bits_to_bytes(binary_string)
+        byte_data, pad_len = bits_to_bytes(binary)
         compressed_data = lzma.compress(byte_data, preset=9 | lzma.PRESET_EXTREME)
-        compressed_bits = ''.join(f'{byte:08b}' for byte in compressed_data)
-        pad_len_bits = f'{pad_len:08b}'
-        return pad_len_bits + compressed_bits
+        return BitBuffer.from_int(pad_len, 8) + BitBuffer.from_bytes(compressed_data)
     else:
         raise NotImplementedError
 
-def binary_decompress(compressed_binary_string, method='lzma'):
+def binary_decompress(compressed_binary, method='lzma'):
     """
-    Decompresses the compressed binary string back to the original binary string.
+    Decompresses the compressed binary data back to the original binary data.
+
+    :param compressed_binary: The compressed binary data.
+    :type compressed_binary: BitBuffer, str
+    :rtype: BitBuffer
     """
     if method == 'lzma':
-        pad_len_bits = compressed_binary_string[:8]
-        pad_len = int(pad_len_bits, 2)
-        compressed_bits = compressed_binary_string[8:]
-        compressed_bytes = bytearray()
-        for i in range(0, len(compressed_bits), 8):
-            byte = compressed_bits[i:i+8]
-            compressed_bytes.append(int(byte, 2))
-        compressed_bytes = bytes(compressed_bytes)
+        compressed_binary = as_bits(compressed_binary)
+        pad_len = compressed_binary[:8].to_int()
+        compressed_bytes = compressed_binary[8:].tobytes()
         byte_data = lzma.decompress(compressed_bytes)
         original_bits = bytes_to_bits(byte_data, pad_len)
         return original_bits
@@ -2,12 +2,14 @@ from numpy import random
 import numpy as np
 
 from stegosphere import utils, io
+from stegosphere.bitbuffer import BitBuffer, as_bits
 
 __all__ = ['roundrobin_chunks', 'split_encode','split_decode', 'weighted_chunks']
 
 def weighted_chunks(payload, num_instances, weights):
     """
     Splits payload into num_instances chunks according to weights.
+    Chunks are slices of payload, thus of the same type.
     """
     assert sum(weights)==1
     assert len(weights)==num_instances
@@ -35,46 +37,44 @@ def weighted_chunks(payload, num_instances, weights):
 def roundrobin_chunks(payload, num_instances):
     """
     Distribute payload in a cycle / round-robin.
-    """
-    rosters = [[] for _ in range(num_instances)]
-    for i, bit in enumerate(payload):
-        rosters[i % num_instances].append(bit)
 
-    return [''.join(chunk) for chunk in rosters]
+    :param payload: The payload to be distributed.
+    :type payload: BitBuffer, str
+    :param num_instances: The number of instances.
+    :type num_instances: int
+
+    :return: The payload chunks.
+    :rtype: list of BitBuffer
+    """
+    bits = as_bits(payload).unpack()
+    return [BitBuffer.from_bits(bits[i::num_instances]) for i in range(num_instances)]
 
 def reverse_roundrobin(payload, num_instances):
     """
     Reconstruct payload from round-robin payload.
     
-    :param payload: The entire string distributed using round-robin.
-    :type payload: str
+    :param payload: The entire payload distributed using round-robin.
+    :type payload: BitBuffer, str
     :param num_instances: The number of instances used
     :type num_instances: int
     
     :return: Reconstructed payload.
-    :rtype: str
+    :rtype: BitBuffer
     """
-    chunk_lengths = [len(payload) // num_instances] * num_instances
-    remainder = len(payload) % num_instances
+    bits = as_bits(payload).unpack()
+    chunk_lengths = [len(bits) // num_instances] * num_instances
+    remainder = len(bits) % num_instances
     
     for i in range(remainder):
         chunk_lengths[i] += 1
     
-    chunks = []
+    output = np.empty_like(bits)
     start = 0
-    for length in chunk_lengths:
-        chunks.append(payload[start:start + length])
+    for i, length in enumerate(chunk_lengths):
+        output[i::num_instances] = bits[start:start + length]
         start += length
     
-
-    output = [''] * len(payload)
-    positions = [0] * num_instances
-    for i in range(len(payload)):
-        chunk_index = i % num_instances
-        output[i] = chunks[chunk_index][positions[chunk_index]]
-        positions[chunk_index] += 1
-    
-    return ''.join(output)
+    return BitBuffer.from_bits(output)
 
 
 
@@ -84,7 +84,7 @@ def split_encode(payload, instances, seed=None, distribution='even', distributio
     Encodes a payload across several instances.
 
     :param payload: The payload to be encoded.
-    :type payload: str
+    :type payload: BitBuffer, str
     :param instances: The iterable of instances.
     :type instances: list
     :param seed: Seed to pseudo-randomly distribute the payload over the different instances.
@@ -98,12 +98,10 @@ def split_encode(payload, instances, seed=None, distribution='even', distributio
     :rtype: list
     """
 
-    
+    payload = as_bits(payload)
     if seed:
         indices = utils.prng_indices(len(payload), seed)
-        payload = ''.join(payload[i] for i in indices)
-    else:
-        indices = np.arange(len(payload))
+        payload = BitBuffer.from_bits(payload.unpack()[indices])
 
     num_instances = len(instances)
     payload_chunks = []
@@ -141,9 +139,9 @@ def split_decode(instances, seed=None, distribution=None, distribution_args=None
        :type distribution_args: dict, optional
 
        :return: The decoded payload
-       :rtype: str
+       :rtype: BitBuffer
     """
-    output = ''
+    output = BitBuffer()
     for instance in instances:
         output += instance()
     if distribution == 'roundrobin':
@@ -153,7 +151,6 @@ def split_decode(instances, seed=None, distribution=None, distribution_args=None
         return output
     else:
         indices = utils.prng_indices(len(output),seed)
-        zeros = np.zeros(len(output),dtype=int)
-        for bit, index in zip(output, indices):
-            zeros[index] = bit
-        return ''.join(map(str, zeros))
+        bits = np.empty(len(output), dtype=np.uint8)
+        bits[indices] = output.unpack()
+        return BitBuffer.from_bits(bits)
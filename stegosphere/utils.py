@@ -1,44 +1,283 @@
-import numpy as np
-
-def dtype_range(dtype):
-    """
-    Gets minimum/maximum value of numpy datatype.
-
-    :param dtype: dtype to be checked
-    :return: tuple, with minimum and maximum value.
-    """
-    if np.issubdtype(dtype, np.integer):
-        info = np.iinfo(dtype)
-    elif np.issubdtype(dtype, np.floating):
-        info = np.finfo(dtype)
-    else:
-        raise Exception('array dtype must be integer or float.')
-    return info.min, info.max
-
-def prng_indices(length, key):
-    """
-    Shuffles indices of array using PCG64DXSM.
-
-    :param length: Length of array.
-    :param key: Seed to use for the PRNG.
-    :return: Shuffled indices.
-    """
-    if type(key)!=int:
-        key = np.frombuffer(key.encode(), dtype=np.uint32)
-    rng = np.random.Generator(np.random.PCG64DXSM(seed=key))
-    indices = np.arange(length)
-    rng.shuffle(indices)
-    return indices
-
-def generate_binary_payload(length):
-    """
-    Generate a binary payload.
-
-    :param length: The length of the payload.
-    :type length: int
-
-    :return: payload
-    :rtype: str
-    """
-    binary_array = np.random.randint(0, 2, size=length)
-    return ''.join(map(str, binary_array))
+import collections
+import functools
+import threading
+
+import numpy as np
+
+from stegosphere.bitbuffer import BitBuffer
+
+def dtype_range(dtype):
+    """
+    Gets minimum/maximum value of numpy datatype.
+
+    :param dtype: dtype to be checked
+    :return: tuple, with minimum and maximum value.
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+    elif np.issubdtype(dtype, np.floating):
+        info = np.finfo(dtype)
+    else:
+        raise Exception('array dtype must be integer or float.')
+    return info.min, info.max
+
+def prepare_out(array, out):
+    """
+    Returns the array to embed into: a copy of array, or out holding the values of array.
+
+    :param array: The cover array.
+    :param out: Array to write the result into, or None for a copy. out=array embeds in place.
+    :return: The array to embed into.
+    """
+    if out is None:
+        return array.copy()
+    if out.shape != array.shape or out.dtype != array.dtype:
+        raise ValueError('out must have the same shape and dtype as array.')
+    if out is not array:
+        np.copyto(out, array)
+    return out
+
+def unsigned_view(values):
+    """
+    View of an integer array as unsigned integers of the same width, for bit manipulation.
+
+    :param values: Integer array.
+    :return: View of values.
+    """
+    return values.view(np.dtype(f'u{values.dtype.itemsize}'))
+
+#Number of Feistel rounds of the keyed permutation
+PERMUTATION_ROUNDS = 4
+_PERMUTATION_BLOCK = 1 << 16
+
+def prng_indices(length, key, count=None, offset=0):
+    """
+    Pseudo-random permutation of the indices of an array, derived from a key.
+    Only `count` indices starting at `offset` are computed, in O(count) time and memory.
+    If the permutation cache is enabled (see enable_permutation_cache), results are cached.
+
+    :param length: Length of array.
+    :param key: Seed to use for the permutation.
+    :type key: int, str
+    :param count: Number of indices to compute. Defaults to all from offset.
+    :type count: int, optional
+    :param offset: Position in the permutation of the first index.
+    :type offset: int, optional
+    :return: Shuffled indices.
+    """
+    offset = min(offset, length)
+    if count is None:
+        count = length - offset
+    stop = min(offset + count, length)
+    if _permutation_cache is not None:
+        cached = _permutation_cache.get(length, key, stop)
+        if cached is not None:
+            return cached[offset:stop]
+    return keyed_permutation(np.arange(offset, stop, dtype=np.int64), length, key)
+
+class PermutationCache:
+    """
+    Bounded LRU cache of keyed permutations, keyed by (length, key).
+
+    Each entry holds the longest computed prefix of a permutation, in a buffer that grows by doubling.
+    Prefixes larger than max_bytes are not cached. Returned arrays are read-only.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        :param max_bytes: Maximum memory held by cached permutations.
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        #(length, key) -> [buffer, number of computed indices]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, length, key, count):
+        """
+        Returns the first count indices of the permutation of range(length) derived from key,
+        or None if they do not fit into the cache.
+        """
+        max_count = self.max_bytes // np.dtype(np.int64).itemsize
+        cache_key = (length, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[1] >= count:
+                self.hits += 1
+                self._entries.move_to_end(cache_key)
+                return _read_only(entry[0][:count])
+            self.misses += 1
+            if count > max_count:
+                return None
+            computed = 0 if entry is None else entry[1]
+
+        extension = keyed_permutation(np.arange(computed, count, dtype=np.int64), length, key)
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[1] < computed:
+                if computed:
+                    #the prefix was evicted in the meantime
+                    return None
+                entry = self._entries[cache_key] = [np.empty(0, dtype=np.int64), 0]
+            buffer, cached = entry
+            if cached < count:
+                if len(buffer) < count:
+                    buffer = np.empty(min(max(count, 2 * len(buffer)), length, max_count), dtype=np.int64)
+                    buffer[:cached] = entry[0][:cached]
+                    self.bytes += buffer.nbytes - entry[0].nbytes
+                    entry[0] = buffer
+                buffer[cached:count] = extension[cached - computed:]
+                entry[1] = count
+            self._entries.move_to_end(cache_key)
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+            return _read_only(buffer[:count])
+
+    def clear(self):
+        """
+        Removes all entries and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.bytes = 0
+
+    def info(self):
+        """
+        :return: Cache statistics.
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self.bytes,
+                    'entries': len(self._entries), 'max_bytes': self.max_bytes}
+
+def _read_only(array):
+    #views of a cached buffer, which is still extended behind them
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+_permutation_cache = None
+
+def enable_permutation_cache(max_bytes=256 * 2**20):
+    """
+    Enables caching of the permutations generated by prng_indices.
+    Useful when extracting from many same-sized covers with the same key.
+
+    :param max_bytes: Maximum memory held by cached permutations.
+    :type max_bytes: int
+    :return: The cache
+    :rtype: PermutationCache
+    """
+    global _permutation_cache
+    _permutation_cache = PermutationCache(max_bytes)
+    return _permutation_cache
+
+def disable_permutation_cache():
+    """
+    Disables and clears the permutation cache.
+    """
+    global _permutation_cache
+    _permutation_cache = None
+
+def permutation_cache_info():
+    """
+    Statistics of the permutation cache (hits, misses, bytes held, ...), or None if it is disabled.
+
+    :rtype: dict
+    """
+    if _permutation_cache is None:
+        return None
+    return _permutation_cache.info()
+
+def keyed_permutation(positions, length, key):
+    """
+    Maps positions to their value in a keyed pseudo-random permutation of range(length).
+
+    The permutation is a Feistel network over the smallest power of two domain containing
+    range(length). Values outside of range(length) are encrypted again (cycle walking).
+    Every position is mapped independently, so any part of the permutation can be computed
+    without the rest.
+
+    :param positions: Positions within range(length).
+    :type positions: np.ndarray, int
+    :param length: Size of the permuted range.
+    :type length: int
+    :param key: Seed to use for the permutation.
+    :type key: int, str
+    :return: Permuted positions, np.ndarray of int64
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    if positions.size and (positions.min() < 0 or positions.max() >= length):
+        raise IndexError('positions must be within range(length).')
+    domain_bits = max(2, int(length - 1).bit_length())
+    round_keys = _round_keys(key)
+
+    flat = positions.ravel()
+    output = np.empty(flat.size, dtype=np.int64)
+    #blocks small enough for the intermediate arrays to stay in cache
+    for start in range(0, flat.size, _PERMUTATION_BLOCK):
+        values = _feistel(flat[start:start + _PERMUTATION_BLOCK].astype(np.uint64), domain_bits, round_keys)
+        pending = np.flatnonzero(values >= length)
+        while pending.size:
+            walked = _feistel(values[pending], domain_bits, round_keys)
+            values[pending] = walked
+            pending = pending[walked >= length]
+        output[start:start + _PERMUTATION_BLOCK] = values
+    return output.reshape(positions.shape)
+
+@functools.lru_cache(maxsize=64)
+def _round_keys(key):
+    if isinstance(key, (int, np.integer)):
+        seed_sequence = np.random.SeedSequence(int(key))
+    elif isinstance(key, (str, bytes)):
+        data = key.encode() if isinstance(key, str) else key
+        seed_sequence = np.random.SeedSequence(list(data))
+    else:
+        raise TypeError('key must be int or str.')
+    return tuple(seed_sequence.generate_state(PERMUTATION_ROUNDS, dtype=np.uint64).tolist())
+
+def _feistel(values, domain_bits, round_keys):
+    """
+    Feistel network on values of domain_bits bits.
+    For odd widths the halves differ by one bit and swap their widths every round.
+    """
+    left_bits = (domain_bits + 1) // 2
+    right_bits = domain_bits - left_bits
+    left = values >> np.uint64(right_bits)
+    right = values & np.uint64((1 << right_bits) - 1)
+    for round_key in round_keys:
+        #new right half has the width of the old left half
+        mixed = _round_function(right, np.uint64(round_key))
+        mixed &= np.uint64((1 << left_bits) - 1)
+        mixed ^= left
+        left, right = right, mixed
+        left_bits, right_bits = right_bits, left_bits
+    left <<= np.uint64(right_bits)
+    left |= right
+    return left
+
+def _round_function(values, round_key):
+    #multiply-xorshift hash of the keyed value
+    x = values + round_key
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(31)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(29)
+    return x
+
+def generate_binary_payload(length):
+    """
+    Generate a binary payload.
+
+    :param length: The length of the payload.
+    :type length: int
+
+    :return: payload
+    :rtype: BitBuffer
+    """
+    binary_array = np.random.randint(0, 2, size=length, dtype=np.uint8)
+    return BitBuffer.from_bits(binary_array)
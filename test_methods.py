@@ -1,7 +1,11 @@
+import io
+import math
+
 import pytest
 import numpy as np
 
 import stegosphere
+from stegosphere import BitBuffer, utils
 
 from stegosphere.methods import LSB, VD, IWT, BPCS
 from stegosphere.utils import generate_binary_payload as gbp
@@ -28,3 +32,366 @@ def test_method_accuracy(generate_image, payload_generator):
             extracted = method.extract(embedded)
 
         assert payload == extracted
+
+
+def test_bitbuffer_roundtrip(generate_image, payload_generator):
+    payload = str(payload_generator)
+    assert BitBuffer.from_str(payload) == payload
+    assert str(BitBuffer.from_str(payload)[3:517]) == payload[3:517]
+
+    embedded = LSB.embed(generate_image, payload)
+    extracted = LSB.extract(embedded)
+    assert isinstance(extracted, BitBuffer)
+    assert extracted == payload
+
+
+@pytest.mark.parametrize('length', [1, 8, 14, 15, 16, 23, 64, 100])
+def test_bitbuffer_find(length):
+    #patterns from 15 bits on are searched bytewise in every alignment
+    bits = str(BitBuffer.from_bits(np.random.default_rng(length).integers(0, 2, 3000)))
+    buffer = BitBuffer.from_str(bits)
+    for position in [0, 1, 7, 9, 13, 1234, 3000 - length]:
+        pattern = bits[position:position + length]
+        for start in [0, position, position + 1]:
+            assert buffer.find(pattern, start) == bits.find(pattern, start)
+        assert buffer.find(BitBuffer.from_str(pattern)) == bits.find(pattern)
+    assert BitBuffer.from_str('0' * 500).find('0' * (length - 1) + '1') == -1
+    assert BitBuffer.from_str(bits[:length - 1]).find(bits[:length]) == -1
+
+
+def test_lsb_delimiter_max_read(generate_image, payload_generator):
+    embedded = LSB.embed(generate_image, payload_generator, method='delimiter')
+    assert LSB.extract(embedded, method='delimiter', max_read=2000) == payload_generator
+    with pytest.warns(UserWarning, match='Delimiter not found.'):
+        partial = LSB.extract(embedded, method='delimiter', max_read=600)
+    assert len(partial) == 600 and partial == payload_generator[:600]
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.int32, np.uint64])
+def test_lsb_numpy_wide_bits(payload_generator, dtype):
+    info = np.iinfo(dtype)
+    cover = np.random.default_rng(5).integers(info.min, info.max, (40, 50), dtype=dtype, endpoint=True)
+    width = info.bits
+    unsigned = np.dtype(f'uint{width}')
+    try:
+        LSB.BACKEND = False
+        for bits in [9, width - 1, width]:
+            for seed in [None, 3]:
+                stego = LSB.embed(cover, payload_generator, bits=bits, seed=seed)
+                assert stego.dtype == dtype
+                assert LSB.extract(stego, bits=bits, seed=seed) == payload_generator
+                if bits < width:
+                    assert np.array_equal(stego.view(unsigned) >> bits, cover.view(unsigned) >> bits)
+    finally:
+        LSB.BACKEND = True
+
+
+@pytest.mark.parametrize('bits', [1, 3, 8])
+def test_lsb_backend_matches_numpy(generate_image, payload_generator, bits):
+    if LSB._load_backend() is None:
+        pytest.skip('C backend not built')
+    try:
+        native = LSB.embed(generate_image, payload_generator, bits=bits, seed=7)
+        LSB.BACKEND = False
+        numpy_only = LSB.embed(generate_image, payload_generator, bits=bits, seed=7)
+        assert np.array_equal(native, numpy_only)
+        assert LSB.extract(native, bits=bits, seed=7) == payload_generator
+    finally:
+        LSB.BACKEND = True
+    assert LSB.extract(numpy_only, bits=bits, seed=7) == payload_generator
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16])
+def test_lsb_matching(generate_image, payload_generator, dtype):
+    info = np.iinfo(dtype)
+    cover = generate_image.astype(dtype)
+    cover[0, :, 0] = info.min
+    cover[1, :, 0] = info.max
+    stego = LSB.embed(cover, payload_generator, matching=5, seed=3)
+    change = stego.astype(np.int64) - cover
+    assert set(np.unique(change)) <= {-1, 0, 1}
+    assert stego[0, :, 0].min() == info.min and stego[1, :, 0].max() == info.max
+    assert LSB.extract(stego, matching=True, seed=3) == payload_generator
+    try:
+        LSB.BACKEND = False
+        assert np.array_equal(LSB.embed(cover, payload_generator, matching=5, seed=3), stego)
+    finally:
+        LSB.BACKEND = True
+    #None disables matching, 0 is a seed
+    assert np.array_equal(LSB.embed(cover, payload_generator, matching=None), LSB.embed(cover, payload_generator))
+    assert np.array_equal(LSB.embed(cover, payload_generator, matching=0),
+                          LSB.embed(cover, payload_generator, matching=np.int64(0)))
+    with pytest.raises(TypeError):
+        LSB.embed(cover, payload_generator, matching='yes')
+
+
+@pytest.mark.parametrize('matching', [False, True])
+def test_lsb_matrix_embedding(generate_image, payload_generator, matching):
+    stego = LSB.embed(generate_image, payload_generator, matrix=3, seed=2, matching=matching)
+    #at most one change per block of 7 values
+    changed = np.flatnonzero((stego != generate_image).reshape(-1))
+    blocks = utils.prng_indices(generate_image.size, 2)
+    assert np.unique(np.argsort(blocks)[changed] // 7).size == changed.size
+    assert LSB.extract(stego, matrix=3, seed=2) == payload_generator
+
+
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 1000, 1024, 1025, 70001])
+def test_prng_indices(length):
+    for key in [7, 'key']:
+        full = utils.prng_indices(length, key)
+        #non-power-of-two lengths are reached by cycle walking
+        assert np.array_equal(np.sort(full), np.arange(length))
+        assert np.array_equal(utils.prng_indices(length, key), full)
+        for offset, count in [(0, 1), (1, 5), (length // 3, 100), (max(length - 1, 0), 10), (length + 5, 3)]:
+            assert np.array_equal(utils.prng_indices(length, key, count, offset), full[offset:offset + count])
+        assert np.array_equal(utils.prng_indices(length, key, offset=length // 2), full[length // 2:])
+    if length > 2:
+        assert not np.array_equal(utils.prng_indices(length, 7), utils.prng_indices(length, 8))
+    #the cached permutation is extended from its prefix
+    full = utils.prng_indices(length, 7)
+    utils.enable_permutation_cache()
+    try:
+        assert np.array_equal(utils.prng_indices(length, 7, 10, 5), full[5:15])
+        assert np.array_equal(utils.prng_indices(length, 7), full)
+    finally:
+        utils.disable_permutation_cache()
+
+
+def test_permutation_cache(generate_image, payload_generator):
+    cache = utils.enable_permutation_cache()
+    try:
+        embedded = LSB.embed(generate_image, payload_generator, seed='key')
+        for _ in range(3):
+            assert LSB.extract(embedded, seed='key') == payload_generator
+        info = utils.permutation_cache_info()
+        assert info == cache.info()
+        assert info['hits'] > 0 and info['entries'] == 1
+        assert info['bytes'] <= info['max_bytes']
+    finally:
+        utils.disable_permutation_cache()
+    assert LSB.extract(embedded, seed='key') == payload_generator
+
+
+
+@pytest.mark.parametrize('length', [800, 5000])
+def test_permutation_cache_chunks(monkeypatch, length):
+    #chunked reads compute every index once, whether or not the permutation fits into the cache
+    computed = []
+    keyed_permutation = utils.keyed_permutation
+    monkeypatch.setattr(utils, 'keyed_permutation',
+                        lambda positions, *args: computed.append(len(positions)) or keyed_permutation(positions, *args))
+    full = keyed_permutation(np.arange(length), length, 'key')
+    cache = utils.enable_permutation_cache(max_bytes=8 * 1000)
+    try:
+        chunks = [utils.prng_indices(length, 'key', 100, start) for start in range(0, length, 100)]
+        assert np.array_equal(np.concatenate(chunks), full)
+        assert sum(computed) == length
+        assert cache.info()['bytes'] <= 8 * 1000
+        assert cache.info()['entries'] == 1
+    finally:
+        utils.disable_permutation_cache()
+
+def test_embed_out(generate_image, payload_generator):
+    for method in [LSB, VD, BPCS]:
+        expected = method.embed(generate_image, payload_generator)
+        cover = np.zeros((100, 200, 3), dtype=np.uint8)
+        view = cover[:, ::2]
+        view[...] = generate_image
+        result = method.embed(view, payload_generator, out=view)
+        if method == BPCS:
+            result, expected = result[0], expected[0]
+        assert result is view
+        assert np.array_equal(view, expected)
+
+
+def test_bpcs_embedded_map(generate_image, payload_generator):
+    stego, conj_map, used_bits = BPCS.embed(generate_image, payload_generator, embedded_map=True)
+    assert conj_map.dtype == BPCS.CONJ_MAP_DTYPE
+    assert BPCS.extract(stego, None, used_bits, embedded_map=True) == payload_generator
+
+
+@pytest.mark.parametrize('cgc', [False, True])
+def test_bpcs_16bit(generate_image, payload_generator, cgc):
+    cover = generate_image.astype(np.uint16) * 257
+    stego, conj_map, used_bits = BPCS.embed(cover, payload_generator, cgc=cgc)
+    assert stego.dtype == np.uint16
+    assert BPCS.extract(stego, conj_map, used_bits, cgc=cgc) == payload_generator
+
+
+def test_bpcs_workers(generate_image):
+    payload = gbp(50000)
+    sequential = BPCS.embed(generate_image, payload, block_size=4)
+    parallel = BPCS.embed(generate_image, payload, block_size=4, workers=3)
+    assert np.array_equal(sequential[0], parallel[0])
+    assert np.array_equal(sequential[1], parallel[1]) and sequential[2] == parallel[2]
+
+
+def test_vd_int16(payload_generator):
+    audio = (np.sin(np.arange(20000) / 7)[:, None] * [9000, -12000]).astype(np.int16)
+    stego = VD.embed(audio, payload_generator, spatial_dim=1, channel_dim=2, seed=1)
+    assert stego.dtype == np.int16
+    assert VD.extract(stego, spatial_dim=1, channel_dim=2, seed=1) == payload_generator
+
+
+@pytest.mark.parametrize('dtype', [np.int64, np.uint64])
+def test_vd_64bit(payload_generator, dtype):
+    #the ranges of 64 bit dtypes reach beyond the int64 differences, large ones are beyond the dense table
+    rng = np.random.default_rng(4)
+    for cover in [(np.sin(np.arange(20000) / 7)[:, None] * [9000, 12000] + 20000).astype(dtype),
+                  rng.integers(0, 2**40, (3000, 2)).astype(dtype)]:
+        stego = VD.embed(cover, payload_generator, spatial_dim=1, channel_dim=2, seed=1)
+        assert stego.dtype == dtype
+        assert VD.extract(stego, spatial_dim=1, channel_dim=2, seed=1) == payload_generator
+
+
+def _vd_reference_pairs(array, seed):
+    positions = list(np.ndindex(*array.shape[:2]))
+    first, second = VD._get_pairs(array, 2, seed)
+    return [(positions[i], positions[j]) for i, j in zip(first, second)]
+
+
+def _vd_reference_range(ranges, diff):
+    return next(((n, l_i, u_i) for n, l_i, u_i in ranges if l_i <= diff <= u_i), None)
+
+
+def _vd_reference_shift(v1, v2, d, new_d):
+    if d % 2:
+        return v1 - math.ceil((new_d - d) / 2), v2 + math.floor((new_d - d) / 2)
+    return v1 - math.floor((new_d - d) / 2), v2 + math.ceil((new_d - d) / 2)
+
+
+def _vd_reference_embed(array, bits, pairs, channel_dim, ranges):
+    #the per-pair algorithm before vectorization
+    array = array.copy()
+    index = 0
+    for coords1, coords2 in pairs:
+        if index >= len(bits):
+            break
+        for channel in range(channel_dim):
+            v1, v2 = int(array[coords1 + (channel,)]), int(array[coords2 + (channel,)])
+            d = v2 - v1
+            found = _vd_reference_range(ranges, abs(d))
+            if found is None or found[0] <= 0:
+                continue
+            n, l_i, u_i = found
+            if not all(0 <= v <= 255 for v in _vd_reference_shift(v1, v2, d, u_i)):
+                continue
+            secret = int(bits[index:index + n].ljust(n, '0'), 2)
+            new_d = l_i + secret if d >= 0 else -(l_i + secret)
+            array[coords1 + (channel,)], array[coords2 + (channel,)] = _vd_reference_shift(v1, v2, d, new_d)
+            index += n
+    return array
+
+
+def _vd_reference_extract(array, pairs, channel_dim, ranges):
+    bits = ''
+    for coords1, coords2 in pairs:
+        for channel in range(channel_dim):
+            v1, v2 = int(array[coords1 + (channel,)]), int(array[coords2 + (channel,)])
+            d = v2 - v1
+            found = _vd_reference_range(ranges, abs(d))
+            if found is None or found[0] <= 0:
+                continue
+            n, l_i, u_i = found
+            if all(0 <= v <= 255 for v in _vd_reference_shift(v1, v2, d, u_i)):
+                bits += bin(abs(d) - l_i)[2:].zfill(n)
+    return bits
+
+
+@pytest.mark.parametrize('seed', [None, 11])
+@pytest.mark.parametrize('channel_dim', [1, 3])
+def test_vd_matches_per_pair_reference(seed, channel_dim):
+    #large enough to span several embedding and extraction windows
+    rng = np.random.default_rng(3)
+    image = np.clip(rng.normal(128, 40, (160, 160, 3)), 0, 255).astype(np.uint8)
+    payload = str(gbp(30000 * channel_dim))
+    ranges = VD._define_range(3, 1, (0, 255))
+    pairs = _vd_reference_pairs(image, seed)
+
+    stego = VD.embed(image, payload, spatial_dim=2, channel_dim=channel_dim, seed=seed, method=None)
+    expected = _vd_reference_embed(image, payload, pairs, channel_dim, ranges)
+    assert np.array_equal(stego, expected)
+    assert str(VD.extract(stego, spatial_dim=2, channel_dim=channel_dim, seed=seed, method=None, n_bits=None)) \
+        == _vd_reference_extract(stego, pairs, channel_dim, ranges)
+
+
+@pytest.mark.parametrize('mode', ['lsb', 'de'])
+def test_iwt_embedding(payload_generator, mode):
+    #smooth image with saturated areas, odd dimensions
+    y, x = np.mgrid[:121, :99]
+    cover = np.clip(np.stack([x * 3, y * 2, x + y], axis=-1) - 20, 0, 255).astype(np.uint8)
+    stego = IWT.embed(cover, payload_generator, levels=2, mode=mode, seed=4, skip_last_axis=True)
+    assert stego.dtype == np.uint8 and stego.shape == cover.shape
+    assert IWT.extract(stego, levels=2, mode=mode, seed=4, skip_last_axis=True) == payload_generator
+    diagonal = dict(subbands=[('1', '1')], skip_last_axis=True, method='delimiter')
+    hf = IWT.extract(IWT.embed(cover, payload_generator, mode=mode, **diagonal), mode=mode, **diagonal)
+    assert hf == payload_generator
+
+
+def test_iwt_coefficients(generate_image):
+    image = generate_image[:99]
+    coeffs, meta = IWT.transform(image, skip_last_axis=True)
+    assert coeffs.array.dtype == np.int16 and len(coeffs) == 4
+    #axis 0 is transformed first: approximation along axis 1 of the details along axis 0
+    detail = image[:98:2].astype(np.int64) - image[1:98:2]
+    assert np.array_equal(coeffs[('1', '0')], (detail[:, ::2] + detail[:, 1::2]) // 2)
+    coeffs[('1', '1')] = coeffs[('1', '1')] ^ 1
+    assert np.shares_memory(coeffs[('1', '1')], coeffs.array)
+    stego = IWT.inverse(coeffs, meta)
+    assert stego.shape == image.shape and np.array_equal(stego[98], image[98])
+    assert IWT.inverse(dict(coeffs), meta).tolist() == stego.tolist()
+
+
+def test_iwt_tiled(generate_image, tmp_path):
+    image = np.memmap(tmp_path / 'image', dtype=np.uint8, mode='w+', shape=(99, 100, 3))
+    image[:] = generate_image[:99] // 2 + 64
+    coefficients = np.memmap(tmp_path / 'coefficients', dtype=np.int16, mode='w+', shape=image.shape)
+    tiled, tiled_meta = IWT.transform_tiled(image, coefficients, skip_last_axis=True, tile_size=1000)
+    for dtype in [np.uint8, np.uint16, np.int8]:
+        with pytest.raises(ValueError):
+            IWT.transform_tiled(image, np.empty(image.shape, dtype=dtype), skip_last_axis=True)
+    coeffs, meta = IWT.transform(np.asarray(image), skip_last_axis=True)
+    for key in coeffs:
+        assert np.array_equal(tiled[key], coeffs[key])
+    tiled[('1', '1')] ^= 1
+    coeffs[('1', '1')] ^= 1
+    stego = IWT.inverse_tiled(coefficients, np.empty_like(generate_image[:99]), skip_last_axis=True, tile_size=1000)
+    assert np.array_equal(stego, IWT.inverse(coeffs, meta))
+    assert np.array_equal(IWT.inverse(tiled, tiled_meta), stego)
+    #without out, the odd last slice is kept as well
+    tiled, tiled_meta = IWT.transform_tiled(np.asarray(image), skip_last_axis=True, tile_size=1000)
+    assert np.array_equal(IWT.inverse(tiled, tiled_meta), image)
+    #out is left unchanged if a later tile does not fit
+    coefficients[97] = np.iinfo(np.int16).max
+    target = np.zeros_like(generate_image[:99])
+    with pytest.raises(OverflowError):
+        IWT.inverse_tiled(coefficients, target, skip_last_axis=True, tile_size=1000)
+    assert not target.any()
+
+
+def test_io_text_roundtrip(generate_image):
+    text = 'Grüße, 世界 ✓'
+    assert stegosphere.data_to_binary(text) == stegosphere.data_to_binary(text.encode('utf-8'))
+    assert stegosphere.data_to_binary(1 << 20) == '000100000000000000000000'
+    #arrays are converted to their raw bytes, wider dtypes are not truncated
+    values = np.array([[300, -1], [7, -32768]], dtype='<i2')
+    assert stegosphere.data_to_binary(values) == stegosphere.data_to_binary(values.tobytes())
+    assert stegosphere.data_to_binary(values.T) == stegosphere.data_to_binary(values.T.tobytes())
+    assert np.array_equal(np.frombuffer(stegosphere.binary_to_data(stegosphere.data_to_binary(values)), '<i2'),
+                          values.reshape(-1))
+    assert stegosphere.data_to_binary(np.array([1.7])) == stegosphere.data_to_binary(np.array([1.7]).tobytes())
+    extracted = LSB.extract(LSB.embed(generate_image, text))
+    assert stegosphere.binary_to_data(extracted, encoding='utf-8') == text
+
+
+def test_lsb_file_stream(generate_image):
+    data = bytes(range(256)) * 8
+    expected = LSB.embed(generate_image, data, seed=6)
+    stego = LSB.embed(generate_image, io.BytesIO(data), seed=6)
+    assert np.array_equal(stego, expected)
+    sink = io.BytesIO()
+    assert LSB.extract(stego, seed=6, sink=sink) == len(data) * 8
+    assert sink.getvalue() == data
+    #the delimiter must not start within the end of the data
+    with pytest.raises(ValueError):
+        LSB.embed(generate_image, io.BytesIO(b'hello ###END##'), method='delimiter')